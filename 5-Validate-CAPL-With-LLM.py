@@ -3,11 +3,20 @@ CAPL Validator - LLM-powered policy cleanup
 Reads rough/imprecise CAPL files and uses Azure OpenAI to convert them to valid CAPL syntax
 """
 
+import argparse
+import asyncio
+import functools
+import hashlib
+import math
 import os
+import random
+import re
 import sys
+from collections import defaultdict
 from pathlib import Path
 from dotenv import load_dotenv
-import requests
+import httpx
+import orjson
 
 # Load environment variables
 load_dotenv()
@@ -15,14 +24,39 @@ load_dotenv()
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
 AZURE_API_KEY = os.getenv("AZURE_API_KEY")
 
-# Validate credentials
-if not AZURE_ENDPOINT or not AZURE_API_KEY:
-    print("Error: Missing Azure OpenAI credentials!")
-    print("Please set AZURE_ENDPOINT and AZURE_API_KEY in your .env file")
-    sys.exit(1)
+# Maximum number of in-flight Azure OpenAI requests (tune to your deployment's rate limit)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Retry policy for transient Azure OpenAI failures (rate limiting and server errors)
+MAX_ATTEMPTS = 6
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Longest wait between attempts in seconds (the last exponential backoff step); also caps Retry-After
+MAX_RETRY_DELAY = 2 ** (MAX_ATTEMPTS - 2)
+
+# Bounds for max_completion_tokens, which is sized from the input (output is roughly input-sized)
+MIN_COMPLETION_TOKENS = 2048
+MAX_COMPLETION_TOKENS = 16000
+
+# Token budget: drafts using more than this share of the context window are skipped
+CONTEXT_WINDOW_TOKENS = 128000
+MAX_INPUT_TOKENS_PER_FILE = int(CONTEXT_WINDOW_TOKENS * 0.6)
+
+# Default input price used by --estimate (USD per 1M input tokens, gpt-4o list price)
+DEFAULT_INPUT_PRICE_PER_MILLION = 2.50
+
+# Small drafts are sent together in one request (up to this many characters of
+# rough input per request), so the system prompt is paid once per batch, not per file
+BATCH_MAX_CHARS = 40000
+
+# Cache of cleaned LLM responses, keyed by prompt version + endpoint + input content
+# Bump PROMPT_VERSION whenever the prompt or request parameters change
+PROMPT_VERSION = "v3"
+CACHE_FOLDER = Path(".capl_cache")
 
 
 # System prompt explaining CAPL syntax
+# Do not mutate or interpolate per request: Azure OpenAI prompt caching matches on an
+# identical message prefix, so this must stay the first message and byte-identical across calls
 SYSTEM_PROMPT = """You are a Conditional Access Policy Language (CAPL) expert. Your task is to take rough, imprecise policy descriptions and convert them into valid CAPL syntax.
 
 ## CAPL Syntax Rules
@@ -143,91 +177,433 @@ Return ONLY the valid CAPL code. Do not include explanations, markdown code fenc
 Just return the clean, valid CAPL syntax that can be directly saved to a .capl file.
 
 If you need to add clarifying comments, use # at the start of the line.
+
+## Multiple Files
+
+The input may contain several files, each starting with a `===FILE: name===` line and
+followed by a final `===END===` line. In that case, convert each file separately and
+return every file under the same `===FILE: name===` line, in the same order, followed
+by `===END===`. Never merge policies from different files.
 """
 
+# Built once and shared by every request so the system prefix is byte-identical across calls
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+BASE_PAYLOAD = {
+    "temperature": 0.3,  # Lower temperature for more precise syntax
+}
+
+
+def get_retry_delay(response, attempt):
+    """Seconds to wait before the next attempt: Retry-After if given, else exponential backoff, plus jitter"""
+    delay = min(2 ** attempt, MAX_RETRY_DELAY)
+    if response is not None and "Retry-After" in response.headers:
+        try:
+            retry_after = float(response.headers["Retry-After"])
+        except ValueError:
+            retry_after = None  # HTTP-date form of Retry-After, fall back to exponential backoff
+        if retry_after is not None and 0 <= retry_after < math.inf:
+            delay = min(retry_after, MAX_RETRY_DELAY)
+    return delay + random.uniform(0, 0.5)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding():
+    """Return the tiktoken encoding for GPT-4o-class models, or None if tiktoken is unavailable"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # Not installed, or the encoding file could not be downloaded
+        return None
+
+
+def approx_token_count(text):
+    """Cheap token estimate at ~4 characters per token (no tokenizer to load)"""
+    return len(text) // 4
+
+
+def count_tokens(text):
+    """Count tokens with tiktoken if available, else estimate at ~4 characters per token"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return approx_token_count(text)
+    return len(encoding.encode(text))
+
+
+def get_completion_token_limit(user_content):
+    """Completion budget of ~4x the input tokens (estimated at 4 chars/token), within bounds"""
+    approx_input_tokens = approx_token_count(user_content)
+    return min(MAX_COMPLETION_TOKENS, max(MIN_COMPLETION_TOKENS, approx_input_tokens * 4))
 
-def call_azure_llm(user_content):
+
+async def post_with_retry(client, payload, label=""):
+    """POST to Azure OpenAI, retrying on 429/5xx and connection errors"""
+    body = orjson.dumps(payload)
+    for attempt in range(MAX_ATTEMPTS):
+        response = None
+        try:
+            response = await client.post(AZURE_ENDPOINT, content=body)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRY_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+            reason = f"HTTP {e.response.status_code}"
+        except httpx.TransportError as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            reason = type(e).__name__
+        
+        delay = get_retry_delay(response, attempt)
+        print(f"  [{label}] {reason}, retrying in {delay:.1f}s (attempt {attempt + 2}/{MAX_ATTEMPTS})")
+        await asyncio.sleep(delay)
+
+
+async def call_azure_llm(client, user_content, label=""):
     """
     Call Azure OpenAI to validate and correct CAPL syntax
     
     Args:
+        client: Shared httpx.AsyncClient (carries auth headers and timeout)
         user_content: The rough CAPL policy text
+        label: Prefix for progress messages (usually the file name)
     
     Returns:
-        The corrected CAPL text
+        The corrected CAPL text, or None if it is missing or was truncated
     """
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AZURE_API_KEY,
-    }
-    
     payload = {
-        "messages": [
-            {
-                "role": "system",
-                "content": SYSTEM_PROMPT
-            },
-            {
-                "role": "user",
-                "content": user_content
-            }
-        ],
-        "max_completion_tokens": 16000,
-        "temperature": 0.3,  # Lower temperature for more precise syntax
+        **BASE_PAYLOAD,
+        "messages": [SYSTEM_MESSAGE, {"role": "user", "content": user_content}],
+        "max_completion_tokens": get_completion_token_limit(user_content),
     }
     
     try:
-        print("Calling Azure OpenAI for CAPL validation...")
+        print(f"  [{label}] Calling Azure OpenAI for CAPL validation "
+              f"(max {payload['max_completion_tokens']:,} completion tokens)...")
         
-        response = requests.post(
-            AZURE_ENDPOINT,
-            headers=headers,
-            json=payload,
-            timeout=120
-        )
-        response.raise_for_status()
+        response = await post_with_retry(client, payload, label)
         
-        result = response.json()
+        result = orjson.loads(response.content)
         
         # Show token usage
         if "usage" in result:
             usage = result["usage"]
-            print(f"  Token usage: {usage.get('total_tokens', 0):,} tokens")
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            print(f"  [{label}] Token usage: {usage.get('total_tokens', 0):,} tokens "
+                  f"({cached:,} prompt tokens served from cache)")
         
         # Extract content
         if "choices" in result and len(result["choices"]) > 0:
             choice = result["choices"][0]
+            # Cut off at max_completion_tokens: the last policy (or batch block) is incomplete,
+            # so the output must not be saved or cached; batched drafts get retried on their own
+            if choice.get("finish_reason") == "length":
+                print(f"  [{label}] WARNING: Response truncated at the completion token limit, discarding it")
+                return None
             if "message" in choice and "content" in choice["message"]:
                 return choice["message"]["content"]
         
-        print("WARNING: Could not extract content from LLM response")
+        print(f"  [{label}] WARNING: Could not extract content from LLM response")
         return None
     
-    except requests.exceptions.RequestException as e:
-        print(f"Error calling Azure OpenAI: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Response status: {e.response.status_code}")
-            print(f"Response body: {e.response.text}")
+    except httpx.HTTPError as e:
+        print(f"  [{label}] Error calling Azure OpenAI: {e}")
+        if isinstance(e, httpx.HTTPStatusError):
+            print(f"  [{label}] Response status: {e.response.status_code}")
+            print(f"  [{label}] Response body: {e.response.text}")
         raise
 
 
+def get_cache_path(rough_content):
+    """Return the cache file path for a rough CAPL input"""
+    key_source = f"{PROMPT_VERSION}|{AZURE_ENDPOINT}|{SYSTEM_PROMPT}|{rough_content}"
+    key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    return CACHE_FOLDER / f"{key}.capl"
+
+
+def read_cache(rough_content):
+    """Return the cached cleaned CAPL for this input, or None on a cache miss"""
+    cache_path = get_cache_path(rough_content)
+    if not cache_path.exists():
+        return None
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write_cache(rough_content, corrected_content):
+    """Store cleaned CAPL in the cache (atomic rename so partial writes are never read)"""
+    CACHE_FOLDER.mkdir(exist_ok=True)
+    cache_path = get_cache_path(rough_content)
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(corrected_content)
+    tmp_path.replace(cache_path)
+
+
 def clean_llm_output(content):
     """Remove markdown code fences if LLM added them"""
-    lines = content.strip().split('\n')
+    content = content.strip()
+    
+    # Remove opening code fence (first line)
+    if content.startswith('```'):
+        content = content.partition('\n')[2]
+    
+    # Remove closing code fence (last line)
+    last_newline = content.rfind('\n')
+    if content.startswith('```', last_newline + 1):
+        content = content[:max(last_newline, 0)]
+    
+    return content
+
+
+# Matches one "===FILE: name===" block of a batched response (up to the next block or ===END===)
+BATCH_FILE_PATTERN = re.compile(
+    r'^===FILE: (.+?)===[ \t]*\n(.*?)(?=^===FILE: |^===END===|\Z)',
+    re.MULTILINE | re.DOTALL
+)
+
+
+def build_batch_message(batch):
+    """Join several (capl_file, rough_content) drafts into one delimited user message"""
+    parts = [f"===FILE: {capl_file.name}===\n{rough_content}" for capl_file, rough_content in batch]
+    parts.append("===END===")
+    return '\n'.join(parts)
+
+
+def split_batch_response(content):
+    """Split a batched LLM response into {file name: corrected content}"""
+    return {name.strip(): body for name, body in BATCH_FILE_PATTERN.findall(content)}
+
+
+def group_into_batches(drafts):
+    """Group drafts into batches of at most BATCH_MAX_CHARS (oversized drafts go alone)"""
+    batches = []
+    current = []
+    current_size = 0
     
-    # Remove opening code fence
-    if lines[0].startswith('```'):
-        lines = lines[1:]
+    for draft in drafts:
+        size = len(draft[1])
+        if current and current_size + size > BATCH_MAX_CHARS:
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(draft)
+        current_size += size
     
-    # Remove closing code fence
-    if lines[-1].startswith('```'):
-        lines = lines[:-1]
+    if current:
+        batches.append(current)
     
-    return '\n'.join(lines)
+    return batches
+
+
+async def save_output(capl_file, rough_content, corrected_content, output_folder, duplicates):
+    """Cache and save the corrected version of a draft (disk I/O runs in a worker thread)"""
+    await asyncio.to_thread(write_cache, rough_content, corrected_content)
+    
+    print(f"  [{capl_file.name}] Output size: {len(corrected_content)} characters")
+    
+    # Drafts with identical content share the same result
+    for target_file in [capl_file] + duplicates.get(rough_content, []):
+        output_file = output_folder / target_file.name
+        await asyncio.to_thread(output_file.write_text, corrected_content, encoding='utf-8')
+        print(f"  [{target_file.name}] ✓ Saved to: {output_file}")
+
+
+async def process_batch(client, semaphore, batch, output_folder, duplicates):
+    """Validate a batch of (capl_file, rough_content) drafts with a single LLM call"""
+    missing = []
+    
+    async with semaphore:
+        names = ', '.join(capl_file.name for capl_file, _ in batch)
+        print(f"Processing: {names}")
+        
+        try:
+            if len(batch) == 1:
+                capl_file, rough_content = batch[0]
+                corrected_content = await call_azure_llm(client, rough_content, capl_file.name)
+                
+                if not corrected_content:
+                    print(f"  [{capl_file.name}] ✗ Failed to get corrected content")
+                    return
+                
+                # Clean up any markdown fences
+                await save_output(capl_file, rough_content, clean_llm_output(corrected_content), output_folder, duplicates)
+                return
+            
+            label = f"batch of {len(batch)}"
+            response = await call_azure_llm(client, build_batch_message(batch), label)
+            results = split_batch_response(response) if response else {}
+            
+            for capl_file, rough_content in batch:
+                if capl_file.name in results:
+                    corrected_content = clean_llm_output(results[capl_file.name])
+                    await save_output(capl_file, rough_content, corrected_content, output_folder, duplicates)
+                else:
+                    print(f"  [{capl_file.name}] Missing from batched response, retrying on its own")
+                    missing.append((capl_file, rough_content))
+        
+        except Exception as e:
+            print(f"  ✗ Error processing {names}: {e}")
+            import traceback
+            traceback.print_exc()
+            return
+    
+    # Retry files the model dropped from the batch individually (outside the semaphore slot)
+    for draft in missing:
+        await process_batch(client, semaphore, [draft], output_folder, duplicates)
+
+
+def classify_drafts(capl_files, rough_contents, cached_contents):
+    """
+    Decide per draft (in file order) what a run does with it
+    
+    Yields (capl_file, rough_content, kind, detail), where kind is one of:
+        'cached'       served from the cache (detail: the cached output)
+        'over_budget'  skipped, estimated over MAX_INPUT_TOKENS_PER_FILE
+        'duplicate'    same content as an earlier draft (detail: that draft's file)
+        'send'         sent to Azure OpenAI
+    """
+    first_file_by_content = {}
+    for capl_file, rough_content, corrected_content in zip(capl_files, rough_contents, cached_contents):
+        if corrected_content is not None:
+            yield capl_file, rough_content, 'cached', corrected_content
+        elif approx_token_count(rough_content) > MAX_INPUT_TOKENS_PER_FILE:
+            # Estimated, so normal runs never load tiktoken (the budget leaves 40% of the window as margin)
+            yield capl_file, rough_content, 'over_budget', None
+        elif rough_content in first_file_by_content:
+            yield capl_file, rough_content, 'duplicate', first_file_by_content[rough_content]
+        else:
+            first_file_by_content[rough_content] = capl_file
+            yield capl_file, rough_content, 'send', None
+
+
+async def process_files(capl_files, output_folder, use_cache=True):
+    """Process all files over a single shared HTTP client (use_cache=False ignores cached results)"""
+    # Read drafts and cache entries in worker threads, then serve cache hits without touching the network
+    rough_contents = await asyncio.gather(*(
+        asyncio.to_thread(capl_file.read_text, encoding='utf-8')
+        for capl_file in capl_files
+    ))
+    if use_cache:
+        cached_contents = await asyncio.gather(*(
+            asyncio.to_thread(read_cache, rough_content)
+            for rough_content in rough_contents
+        ))
+    else:
+        cached_contents = [None] * len(rough_contents)
+    
+    drafts = []
+    duplicates = defaultdict(list)  # rough content -> further files with that exact content
+    cached_output_writes = []
+    for capl_file, rough_content, kind, detail in classify_drafts(capl_files, rough_contents, cached_contents):
+        if kind == 'cached':
+            print(f"  [{capl_file.name}] Cache hit, skipping Azure OpenAI call")
+            output_file = output_folder / capl_file.name
+            cached_output_writes.append(asyncio.to_thread(output_file.write_text, detail, encoding='utf-8'))
+            print(f"  [{capl_file.name}] ✓ Saved to: {output_file}")
+        elif kind == 'over_budget':
+            print(f"  [{capl_file.name}] ✗ Skipped: over the {MAX_INPUT_TOKENS_PER_FILE:,} input token budget, split it into smaller files")
+        elif kind == 'duplicate':
+            print(f"  [{capl_file.name}] Identical to {detail.name}, reusing its result")
+            duplicates[rough_content].append(capl_file)
+        else:
+            print(f"  [{capl_file.name}] Input size: {len(rough_content)} characters")
+            drafts.append((capl_file, rough_content))
+    
+    await asyncio.gather(*cached_output_writes)
+    
+    if not drafts:
+        return
+    
+    batches = group_into_batches(drafts)
+    print(f"\nSending {len(drafts)} file(s) in {len(batches)} request(s)\n")
+    
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    # One keep-alive connection per concurrent request, reused across files so
+    # the TCP/TLS handshake to Azure is paid once per connection, not per file
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": AZURE_API_KEY,
+    }
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS
+    )
+    
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=120) as client:
+        await asyncio.gather(*(
+            process_batch(client, semaphore, batch, output_folder, duplicates)
+            for batch in batches
+        ))
+
+
+def estimate_tokens(capl_files, input_price_per_million, use_cache=True):
+    """Print input token counts and estimated cost without calling Azure OpenAI"""
+    if get_token_encoding() is None:
+        print("Note: tiktoken not available, estimating at ~4 characters per token\n")
+    
+    system_tokens = count_tokens(SYSTEM_PROMPT)
+    rough_contents = [capl_file.read_text(encoding='utf-8') for capl_file in capl_files]
+    if use_cache:
+        cached_contents = [read_cache(rough_content) for rough_content in rough_contents]
+    else:
+        cached_contents = [None] * len(rough_contents)
+    
+    drafts = []
+    total_tokens = 0
+    
+    # Only drafts a real run would send count towards the totals
+    print(f"{'File':<40} {'Input tokens':>14}")
+    print("-" * 55)
+    for capl_file, rough_content, kind, detail in classify_drafts(capl_files, rough_contents, cached_contents):
+        if kind == 'cached':
+            print(f"{capl_file.name:<40} {'-':>14} (cached, not sent)")
+        elif kind == 'over_budget':
+            print(f"{capl_file.name:<40} {'-':>14} (over budget, will be skipped)")
+        elif kind == 'duplicate':
+            print(f"{capl_file.name:<40} {'-':>14} (same as {detail.name}, not sent)")
+        else:
+            file_tokens = system_tokens + count_tokens(rough_content)
+            total_tokens += file_tokens
+            drafts.append((capl_file, rough_content))
+            print(f"{capl_file.name:<40} {file_tokens:>14,}")
+    print("-" * 55)
+    print(f"{'Total (one request per file)':<40} {total_tokens:>14,}")
+    
+    # Batched requests pay the system prompt once per batch
+    batches = group_into_batches(drafts)
+    batched_tokens = total_tokens - (len(drafts) - len(batches)) * system_tokens
+    print(f"{f'Total (batched, {len(batches)} request(s))':<40} {batched_tokens:>14,}")
+    print()
+    print(f"System prompt: {system_tokens:,} tokens per request")
+    print(f"Estimated input cost: ${batched_tokens * input_price_per_million / 1_000_000:.4f} "
+          f"(at ${input_price_per_million:.2f} per 1M input tokens, before cache hits)")
+
+
+def is_up_to_date(capl_file, output_file):
+    """True if the validated output is at least as new as the rough draft"""
+    return output_file.exists() and output_file.stat().st_mtime >= capl_file.stat().st_mtime
 
 
 def main():
     """Main entry point"""
+    arg_parser = argparse.ArgumentParser(description="Validate rough CAPL files with Azure OpenAI")
+    arg_parser.add_argument("--force", action="store_true",
+                            help="re-validate all files with Azure OpenAI, even if the output is newer than the draft "
+                                 "or a cached result exists")
+    arg_parser.add_argument("--estimate", action="store_true",
+                            help="print input token counts and estimated cost without calling Azure OpenAI")
+    arg_parser.add_argument("--input-price", type=float, default=DEFAULT_INPUT_PRICE_PER_MILLION,
+                            help="USD per 1M input tokens used by --estimate (default: %(default)s)")
+    args = arg_parser.parse_args()
+    
+    # Validate credentials (not needed for a dry run)
+    if not args.estimate and (not AZURE_ENDPOINT or not AZURE_API_KEY):
+        print("Error: Missing Azure OpenAI credentials!")
+        print("Please set AZURE_ENDPOINT and AZURE_API_KEY in your .env file")
+        return 1
+    
     print("=" * 60)
     print("CAPL Validator - LLM-powered Policy Cleanup")
     print("=" * 60)
@@ -255,46 +631,26 @@ def main():
         return 1
     
     print(f"Found {len(capl_files)} file(s) to validate:\n")
+    pending_files = []
     for f in capl_files:
-        print(f"  - {f.name}")
+        if not args.force and is_up_to_date(f, output_folder / f.name):
+            print(f"  - {f.name} (up to date, skipping)")
+        else:
+            print(f"  - {f.name}")
+            pending_files.append(f)
     print()
     
-    # Process each file
-    for capl_file in capl_files:
-        print(f"Processing: {capl_file.name}")
-        
-        try:
-            # Read rough policy
-            with open(capl_file, 'r', encoding='utf-8') as f:
-                rough_content = f.read()
-            
-            print(f"  Input size: {len(rough_content)} characters")
-            
-            # Call LLM to fix it
-            corrected_content = call_azure_llm(rough_content)
-            
-            if not corrected_content:
-                print(f"  ✗ Failed to get corrected content")
-                continue
-            
-            # Clean up any markdown fences
-            corrected_content = clean_llm_output(corrected_content)
-            
-            print(f"  Output size: {len(corrected_content)} characters")
-            
-            # Save corrected version
-            output_file = output_folder / capl_file.name
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(corrected_content)
-            
-            print(f"  ✓ Saved to: {output_file}")
-            print()
-            
-        except Exception as e:
-            print(f"  ✗ Error processing {capl_file.name}: {e}")
-            import traceback
-            traceback.print_exc()
-            print()
+    if not pending_files:
+        print("All files are up to date (use --force to re-validate)")
+        return 0
+    
+    if args.estimate:
+        estimate_tokens(pending_files, args.input_price, use_cache=not args.force)
+        return 0
+    
+    # Process all files concurrently (bounded by MAX_CONCURRENT_REQUESTS)
+    asyncio.run(process_files(pending_files, output_folder, use_cache=not args.force))
+    print()
     
     print("=" * 60)
     print("DONE! Validated files saved to 'PolicyLanguage/' folder")
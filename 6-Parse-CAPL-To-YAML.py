@@ -3,17 +3,118 @@ Conditional Access Policy Language (CAPL) Parser with Optimization
 Converts .capl files to YAML policies with path extraction and clustering optimization
 """
 
+import os
 import re
 import yaml
 import sys
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Set, Tuple
+from typing import List, Dict, Any, Optional, Set, Tuple, FrozenSet
 from dataclasses import dataclass, field
 from datetime import datetime
 from collections import defaultdict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
+# Optional google-re2 engine (linear time, no backtracking), opt-in via CAPL_USE_RE2=1.
+# Off by default: per-call overhead makes it slower than re on short CAPL lines, it
+# only pays off for pathological/very long condition text.
+re2 = None
+if os.environ.get('CAPL_USE_RE2') == '1':
+    try:
+        import re2
+    except ImportError:
+        print("Warning: CAPL_USE_RE2=1 but google-re2 is not installed, using re")
 
-@dataclass
+
+# AST/path records are created per line and per path: use __slots__ where
+# dataclasses support it (Python 3.10+) to drop the per-instance __dict__
+DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+# libyaml's C emitter when PyYAML was built with it, else the pure-Python one.
+# Policy dicts must hold only plain dicts/lists/str/int/bool for the safe dumpers.
+try:
+    from yaml import CSafeDumper as YAML_DUMPER
+except ImportError:
+    from yaml import SafeDumper as YAML_DUMPER
+
+
+def compile_pattern(pattern: str):
+    """Compile with google-re2 when enabled, else (or if re2 rejects the syntax) with re"""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern)
+
+
+# Precompiled CAPL patterns (compiled once at import, not looked up per line)
+VAR_RE = re.compile(r'VAR\s+(\w+)\s*=\s*"([^"]+)"\s*\[([^\]]+)\]')
+
+# All condition forms as one alternation. Alternatives are tried in order at the start
+# of the line, so the first listed form that matches wins (same precedence as trying
+# each pattern in turn); m.lastgroup names the form that matched. Only the keywords
+# are case-insensitive ((?i:...)): display names and GUIDs match without case folding.
+CONDITION_RE = compile_pattern('|'.join(f'(?P<{name}>{pattern})' for name, pattern in [
+    # user is All, app is Office365, platform is iOS, ...
+    ('is', r'(?P<is_type>(?i:user|app|platform|device|location|client))\s+(?i:is)\s+(?P<is_value>\w+)'),
+    # user NOT in group "Name" [guid]
+    ('user_not_in', r'(?P<not_in_type>(?i:user))\s+(?i:NOT)\s+(?i:in)\s+(?i:group|role)\s+"(?P<not_in_value>[^"]+)"\s*\[(?P<not_in_guid>[^\]]+)\]'),
+    # user in group "Name" [guid], user in role "Name" [guid]
+    ('user_in', r'(?P<in_type>(?i:user))\s+(?i:in)\s+(?P<in_kind>(?i:group|role))\s+"(?P<in_value>[^"]+)"\s*\[(?P<in_guid>[^\]]+)\]'),
+    # app in "Name" [guid], location in "Name" [guid]
+    ('named_in', r'(?P<named_type>(?i:app|location))\s+(?i:in)\s+"(?P<named_value>[^"]+)"\s*\[(?P<named_guid>[^\]]+)\]'),
+    # location NOT is Trusted, client NOT is Browser
+    ('not_is', r'(?P<not_is_type>(?i:location|client))\s+(?i:NOT)\s+(?i:is)\s+(?P<not_is_value>\w+)'),
+    # signin-risk is High, user-risk is Medium
+    ('risk', r'(?P<risk_type>(?i:signin-risk|user-risk))\s+(?i:is)\s+(?P<risk_value>\w+)'),
+    # device is Compliant, device is HybridJoined
+    ('device', r'(?P<device_type>(?i:device))\s+(?i:is)\s+(?P<device_value>\w+)'),
+]))
+
+# Conditions sections in the order they are written to the policy YAML
+CONDITION_SECTIONS = (
+    'Users', 'Applications', 'Platforms', 'Locations',
+    'ClientAppTypes', 'DeviceStates', 'SignInRiskLevels', 'UserRiskLevels',
+)
+
+# Condition types are interned so the per-type dict lookups and == checks
+# downstream hit the identity fast path
+CONDITION_BUILDERS = {
+    'is': lambda m: Condition(type=sys.intern(m['is_type'].lower()), operator='is', value=m['is_value']),
+    'user_not_in': lambda m: Condition(type=sys.intern(m['not_in_type'].lower()), operator='in', value=m['not_in_value'],
+                                       guid=m['not_in_guid'], is_negated=True),
+    'user_in': lambda m: Condition(type=sys.intern(f"{m['in_type'].lower()}-{m['in_kind'].lower()}"), operator='in',
+                                   value=m['in_value'], guid=m['in_guid']),
+    'named_in': lambda m: Condition(type=sys.intern(m['named_type'].lower()), operator='in', value=m['named_value'],
+                                    guid=m['named_guid']),
+    'not_is': lambda m: Condition(type=sys.intern(m['not_is_type'].lower()), operator='is', value=m['not_is_value'],
+                                  is_negated=True),
+    'risk': lambda m: Condition(type=sys.intern(m['risk_type'].lower()), operator='is', value=m['risk_value']),
+    'device': lambda m: Condition(type=sys.intern(m['device_type'].lower()), operator='is', value=m['device_value']),
+}
+
+# platform is iOS OR platform is Android
+COND_OR_FIRST_RE = re.compile(r'(?i:(platform|client)\s+is)\s+(\w+)')
+COND_OR_PART_RE = re.compile(r'(?i:(?:platform|client)\s+is)\s+(\w+)')
+
+# Leading keyword of a stripped line (IF, ELSE IF, STATE, REQUIRE, ...) when followed
+# by a space, and the rest of the line after it
+LINE_HEADER_RE = re.compile(r'(ELSE IF|[^ ]+) \s*(.*)')
+
+# REQUIRE X [OR Y], BLOCK, ALLOW, SESSION setting
+ACTION_RE = re.compile(
+    r'(?P<REQUIRE>REQUIRE (?P<require_value>.*))'
+    r'|(?P<BLOCK>BLOCK\Z)'
+    r'|(?P<ALLOW>ALLOW\Z)'
+    r'|(?P<SESSION>SESSION (?P<session_value>.*))'
+)
+
+SESSION_SIGNIN_FREQUENCY_RE = re.compile(r'signin-frequency\s+(\d+)\s+(hours?|days?)', re.IGNORECASE)
+SESSION_PERSISTENT_BROWSER_RE = re.compile(r'persistent-browser\s+(always|never)', re.IGNORECASE)
+
+
+@dataclass(**DATACLASS_SLOTS)
 class Condition:
     """Represents a single condition in the policy"""
     type: str  # user, app, platform, device, location, client, signin-risk, user-risk
@@ -23,7 +124,7 @@ class Condition:
     is_negated: bool = False
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Action:
     """Represents an action (grant or session control)"""
     type: str  # REQUIRE, BLOCK, ALLOW, SESSION
@@ -31,7 +132,7 @@ class Action:
     is_or: bool = False  # For "REQUIRE X OR Y"
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class PolicyBranch:
     """Represents one branch of an IF-ELSE tree"""
     conditions: List[Condition] = field(default_factory=list)
@@ -40,7 +141,7 @@ class PolicyBranch:
     nested_if: Optional['IfStatement'] = None
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class IfStatement:
     """Represents an IF-ELSE IF-ELSE structure"""
     if_branch: PolicyBranch = field(default_factory=PolicyBranch)
@@ -48,7 +149,7 @@ class IfStatement:
     else_branch: Optional[PolicyBranch] = None
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Variable:
     """Represents a VAR declaration"""
     name: str
@@ -56,41 +157,37 @@ class Variable:
     guid: str
 
 
-@dataclass
+# Action signature: (is BLOCK, sorted grant controls, sorted session controls)
+ActionSignature = Tuple[bool, Tuple[str, ...], Tuple[str, ...]]
+BLOCK_SIGNATURE: ActionSignature = (True, (), ())
+
+
+@dataclass(**DATACLASS_SLOTS)
 class PolicyPath:
-    """Represents one complete path through the decision tree"""
-    conditions: List[Condition]
-    actions: List[Action]
+    """Represents one complete path through the decision tree (read-only once built)"""
+    conditions: Tuple[Condition, ...]
+    actions: List[Action]  # shared with the leaf PolicyBranch, not copied
     state: str
+    _signature: Optional[ActionSignature] = field(default=None, init=False, repr=False, compare=False)
+    
+    def get_action_signature(self) -> ActionSignature:
+        """Create a signature for clustering by actions (computed once per path)"""
+        if self._signature is None:
+            self._signature = self._build_action_signature()
+        return self._signature
     
-    def get_action_signature(self) -> str:
-        """Create a signature for clustering by actions"""
+    def _build_action_signature(self) -> ActionSignature:
+        """Build the action signature (see get_action_signature)"""
         # Check if this is a BLOCK action
         if any(a.type == 'BLOCK' for a in self.actions):
-            return "BLOCK"
+            return BLOCK_SIGNATURE
         
-        # Group by grant controls and session controls
-        grant_controls = []
-        session_controls = []
+        # Group by grant controls and session controls; deduplicate and sort so
+        # repeated or reordered actions give the same signature (no grant controls: ALLOW)
+        grant_controls = tuple(sorted({a.value for a in self.actions if a.type == 'REQUIRE' and a.value}))
+        session_controls = tuple(sorted({a.value for a in self.actions if a.type == 'SESSION' and a.value}))
         
-        for action in self.actions:
-            if action.type == 'REQUIRE':
-                if action.value:
-                    grant_controls.append(action.value)
-            elif action.type == 'SESSION':
-                if action.value:
-                    session_controls.append(action.value)
-        
-        # Sort for consistent signatures
-        grant_controls.sort()
-        session_controls.sort()
-        
-        grant_sig = ','.join(grant_controls) if grant_controls else 'ALLOW'
-        session_sig = ','.join(session_controls) if session_controls else ''
-        
-        if session_sig:
-            return f"GRANT:{grant_sig}|SESSION:{session_sig}"
-        return f"GRANT:{grant_sig}"
+        return (False, grant_controls, session_controls)
 
 
 class CAPLParser:
@@ -98,58 +195,102 @@ class CAPLParser:
     
     def __init__(self):
         self.variables: Dict[str, Variable] = {}
+        self._variable_re: Optional[re.Pattern] = None  # Built lazily, reset on each VAR
         self.line_number = 0
         self.lines: List[str] = []
+        # Per-line records, computed once per file (parallel to self.lines)
+        self._stripped: List[str] = []
+        self._indents: List[int] = []
+        self._keywords: List[str] = []
+        self._rests: List[str] = []
         
     def parse_file(self, file_path: Path) -> List[IfStatement]:
         """Parse a .capl file and return list of top-level IF statements"""
         print(f"Parsing {file_path.name}...")
         
         with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        self.lines = content.split('\n')
+            self.lines = f.read().splitlines()
         self.line_number = 0
         
+        self._scan_lines()
+        
         statements = []
         
         while self.line_number < len(self.lines):
-            line = self._current_line_stripped()
+            i = self.line_number
+            line = self._stripped[i]
+            keyword = self._keywords[i]
             
             if not line or line.startswith('#'):
                 self.line_number += 1
                 continue
             
-            if line.startswith('VAR '):
+            if keyword == 'VAR':
                 self._parse_variable()
-            elif line.startswith('IF '):
+            elif keyword == 'IF':
                 statements.append(self._parse_if_statement())
             else:
                 self.line_number += 1
         
         return statements
     
+    def _scan_lines(self):
+        """
+        Precompute per-line records (stripped text, indent, keyword, rest) in one pass instead of
+        re-stripping on every inspection; loops that already bound-check line_number index them directly
+        """
+        stripped_lines = []
+        indents = []
+        keywords = []
+        rests = []
+        
+        for raw_line in self.lines:
+            lstripped = raw_line.lstrip()
+            stripped = lstripped.rstrip()
+            stripped_lines.append(stripped)
+            indents.append(len(raw_line) - len(lstripped))
+            
+            # Blank and comment lines are skipped by every loop, no need to split them
+            header = LINE_HEADER_RE.match(stripped) if stripped and stripped[0] != '#' else None
+            if header:
+                keywords.append(header[1])
+                rests.append(header[2])
+            else:
+                keywords.append('')
+                rests.append('')
+        
+        self._stripped = stripped_lines
+        self._indents = indents
+        self._keywords = keywords
+        self._rests = rests
+    
     def _current_line_stripped(self) -> str:
         """Get current line stripped of whitespace"""
         if self.line_number >= len(self.lines):
             return ""
-        return self.lines[self.line_number].strip()
+        return self._stripped[self.line_number]
     
     def _current_line_indent(self) -> int:
         """Get indentation level of current line"""
         if self.line_number >= len(self.lines):
             return 0
-        line = self.lines[self.line_number]
-        return len(line) - len(line.lstrip())
+        return self._indents[self.line_number]
+    
+    def _current_keyword(self) -> str:
+        """Get leading keyword of current line ('IF', 'ELSE IF', 'STATE', ... when followed by a space, else '')"""
+        if self.line_number >= len(self.lines):
+            return ""
+        return self._keywords[self.line_number]
     
     def _parse_variable(self):
         """Parse VAR declaration"""
         line = self._current_line_stripped()
         # VAR BreakGlassGroup = "Emergency Access" [guid]
-        match = re.match(r'VAR\s+(\w+)\s*=\s*"([^"]+)"\s*\[([^\]]+)\]', line)
+        match = VAR_RE.match(line)
         if match:
             var_name, display_name, guid = match.groups()
             self.variables[var_name] = Variable(var_name, display_name, guid)
+            self._variable_re = None
         self.line_number += 1
     
     def _parse_if_statement(self, base_indent: int = 0) -> IfStatement:
@@ -161,13 +302,14 @@ class CAPLParser:
         
         # Parse ELSE IF branches
         while self.line_number < len(self.lines):
-            line = self._current_line_stripped()
-            indent = self._current_line_indent()
+            i = self.line_number
+            line = self._stripped[i]
+            indent = self._indents[i]
             
             if indent < base_indent:
                 break
             
-            if line.startswith('ELSE IF '):
+            if self._keywords[i] == 'ELSE IF':
                 stmt.else_if_branches.append(self._parse_branch(base_indent))
             elif line == 'ELSE':
                 self.line_number += 1  # Consume ELSE
@@ -185,24 +327,19 @@ class CAPLParser:
         branch = PolicyBranch()
         
         # Parse conditions
-        line = self._current_line_stripped()
-        if line.startswith('IF '):
-            # First condition is on same line as IF
-            cond_text = line[3:].strip()
-            if cond_text:
-                branch.conditions.append(self._parse_condition(cond_text))
-            self.line_number += 1
-        elif line.startswith('ELSE IF '):
-            # First condition is on same line as ELSE IF
-            cond_text = line[8:].strip()
+        if self._current_keyword() in ('IF', 'ELSE IF'):
+            # First condition is on same line as IF / ELSE IF
+            cond_text = self._rests[self.line_number]
             if cond_text:
                 branch.conditions.append(self._parse_condition(cond_text))
             self.line_number += 1
         
         # Parse additional conditions (indented lines before STATE)
         while self.line_number < len(self.lines):
-            line = self._current_line_stripped()
-            indent = self._current_line_indent()
+            i = self.line_number
+            line = self._stripped[i]
+            indent = self._indents[i]
+            keyword = self._keywords[i]
             
             if not line or line.startswith('#'):
                 self.line_number += 1
@@ -211,10 +348,10 @@ class CAPLParser:
             if indent <= base_indent and line in ['ELSE IF ', 'ELSE', 'END']:
                 break
             
-            if line.startswith('STATE '):
+            if keyword == 'STATE':
                 break
             
-            if line.startswith('IF '):
+            if keyword == 'IF':
                 # Nested IF statement
                 break
             
@@ -233,16 +370,16 @@ class CAPLParser:
             branch = PolicyBranch()
         
         # Look for STATE keyword
-        line = self._current_line_stripped()
-        if line.startswith('STATE '):
-            state_value = line[6:].strip()
-            branch.state = state_value
+        if self._current_keyword() == 'STATE':
+            branch.state = self._rests[self.line_number]
             self.line_number += 1
         
         # Parse actions or nested IF
         while self.line_number < len(self.lines):
-            line = self._current_line_stripped()
-            indent = self._current_line_indent()
+            i = self.line_number
+            line = self._stripped[i]
+            indent = self._indents[i]
+            keyword = self._keywords[i]
             
             if not line or line.startswith('#'):
                 self.line_number += 1
@@ -254,10 +391,10 @@ class CAPLParser:
             if line in ['ELSE IF ', 'ELSE', 'END']:
                 break
             
-            if line.startswith('IF '):
+            if keyword == 'IF':
                 # Nested IF statement
                 branch.nested_if = self._parse_if_statement(indent)
-            elif line.startswith(('REQUIRE ', 'BLOCK', 'ALLOW', 'SESSION ')):
+            elif keyword in ('REQUIRE', 'SESSION') or line.startswith(('BLOCK', 'ALLOW')):
                 branch.actions.append(self._parse_action(line))
                 self.line_number += 1
             else:
@@ -267,90 +404,93 @@ class CAPLParser:
     
     def _parse_condition(self, text: str) -> Condition:
         """Parse a condition line"""
-        # Replace variables
-        for var_name, var_obj in self.variables.items():
-            if var_name in text:
-                text = text.replace(var_name, f'"{var_obj.display_name}" [{var_obj.guid}]')
-        
-        # user is All
-        # user is Guest
-        if m := re.match(r'(user|app|platform|device|location|client)\s+is\s+(\w+)', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='is', value=m.group(2))
-        
-        # user NOT in group "Name" [guid]
-        if m := re.match(r'(user)\s+NOT\s+in\s+(group|role)\s+"([^"]+)"\s*\[([^\]]+)\]', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='in', value=m.group(3), guid=m.group(4), is_negated=True)
-        
-        # user in group "Name" [guid]
-        # user in role "Name" [guid]
-        if m := re.match(r'(user)\s+in\s+(group|role)\s+"([^"]+)"\s*\[([^\]]+)\]', text, re.IGNORECASE):
-            cond_type = f"{m.group(1).lower()}-{m.group(2).lower()}"
-            return Condition(type=cond_type, operator='in', value=m.group(3), guid=m.group(4))
-        
-        # app in "Name" [guid]
-        if m := re.match(r'(app|location)\s+in\s+"([^"]+)"\s*\[([^\]]+)\]', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='in', value=m.group(2), guid=m.group(3))
-        
-        # location NOT is Trusted
-        if m := re.match(r'(location)\s+NOT\s+is\s+(\w+)', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='is', value=m.group(2), is_negated=True)
-        
-        # client NOT is Browser
-        if m := re.match(r'(client)\s+NOT\s+is\s+(\w+)', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='is', value=m.group(2), is_negated=True)
+        # Replace variables (all names in a single regex pass)
+        if self.variables:
+            if self._variable_re is None:
+                names = '|'.join(re.escape(name) for name in self.variables)
+                # No leading \b: it would stop re from scanning for the names' literal
+                # prefixes; the left word boundary is checked in _expand_variable instead
+                self._variable_re = re.compile(rf'(?:{names})\b')
+            text = self._variable_re.sub(self._expand_variable, text)
+        
+        if m := CONDITION_RE.match(text):
+            return CONDITION_BUILDERS[m.lastgroup](m)
         
         # platform is iOS OR platform is Android
         if ' OR ' in text:
             parts = [p.strip() for p in text.split(' OR ')]
             # Take first part for now, handle OR in conversion
             first = parts[0]
-            if m := re.match(r'(platform|client)\s+is\s+(\w+)', first, re.IGNORECASE):
+            if m := COND_OR_FIRST_RE.match(first):
                 values = []
                 for part in parts:
-                    if m2 := re.match(r'(?:platform|client)\s+is\s+(\w+)', part, re.IGNORECASE):
+                    if m2 := COND_OR_PART_RE.match(part):
                         values.append(m2.group(1))
-                return Condition(type=m.group(1).lower(), operator='is-or', value='|'.join(values))
-        
-        # signin-risk is High
-        # user-risk is Medium
-        if m := re.match(r'(signin-risk|user-risk)\s+is\s+(\w+)', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='is', value=m.group(2))
-        
-        # device is Compliant
-        # device is HybridJoined
-        if m := re.match(r'(device)\s+is\s+(\w+)', text, re.IGNORECASE):
-            return Condition(type=m.group(1).lower(), operator='is', value=m.group(2))
+                return Condition(type=sys.intern(m.group(1).lower()), operator='is-or', value='|'.join(values))
         
         print(f"Warning: Could not parse condition: {text}")
         return Condition(type='unknown', operator='is', value=text)
     
+    def _expand_variable(self, m: re.Match) -> str:
+        """Substitute a variable reference with its display name and GUID"""
+        start = m.start()
+        if start and (m.string[start - 1].isalnum() or m.string[start - 1] == '_'):
+            return m.group(0)  # Tail of a longer word, not a variable reference
+        var_obj = self.variables[m.group(0)]
+        return f'"{var_obj.display_name}" [{var_obj.guid}]'
+    
     def _parse_action(self, text: str) -> Action:
         """Parse an action line"""
+        m = ACTION_RE.match(text)
+        if m is None:
+            return Action(type='UNKNOWN', value=text)
+        
         # REQUIRE MFA
-        # REQUIRE CompliantDevice
-        if text.startswith('REQUIRE '):
-            action_text = text[8:].strip()
-            # Check for OR
+        # REQUIRE AppProtection OR CompliantDevice
+        if m.lastgroup == 'REQUIRE':
+            action_text = m['require_value'].strip()
             if ' OR ' in action_text:
                 parts = action_text.split(' OR ')
                 return Action(type='REQUIRE', value='|'.join(parts), is_or=True)
-            else:
-                return Action(type='REQUIRE', value=action_text)
-        
-        # BLOCK
-        if text == 'BLOCK':
-            return Action(type='BLOCK')
-        
-        # ALLOW
-        if text == 'ALLOW':
-            return Action(type='ALLOW')
+            return Action(type='REQUIRE', value=action_text)
         
         # SESSION signin-frequency 1 hours
-        if text.startswith('SESSION '):
-            session_text = text[8:].strip()
-            return Action(type='SESSION', value=session_text)
+        if m.lastgroup == 'SESSION':
+            return Action(type='SESSION', value=m['session_value'].strip())
         
-        return Action(type='UNKNOWN', value=text)
+        # BLOCK / ALLOW
+        return Action(type=sys.intern(m.lastgroup))
+
+
+# CAPL client type -> Entra clientAppTypes value (anything else is lowercased)
+CLIENT_TYPE_MAP = {
+    'Browser': 'browser',
+    'MobileApp': 'mobileAppsAndDesktopClients',
+    'DesktopApp': 'mobileAppsAndDesktopClients',
+    'ExchangeActiveSync': 'exchangeActiveSync',
+    'Other': 'other'
+}
+
+
+# CAPL grant control -> Entra builtInControls value (anything else is lowercased)
+GRANT_CONTROL_MAP = {
+    'MFA': 'mfa',
+    'CompliantDevice': 'compliantDevice',
+    'HybridJoined': 'domainJoinedDevice',
+    'ApprovedApp': 'approvedApplication',
+    'AppProtection': 'compliantApplication',
+    'PasswordChange': 'passwordChange'
+}
+
+
+# Condition types that can have multiple values in CA policies
+LIST_CAPABLE_TYPES = frozenset({'platform', 'location', 'client', 'app'})
+
+
+@lru_cache(maxsize=64)
+def _map_client_types_cached(client_values: FrozenSet[str]) -> Tuple[str, ...]:
+    """Deduplicated Entra client types for a set of CAPL client values"""
+    return tuple(set(CLIENT_TYPE_MAP.get(c, c.lower()) for c in client_values))
 
 
 class PolicyOptimizer:
@@ -358,6 +498,19 @@ class PolicyOptimizer:
     
     def __init__(self):
         self.policy_counter = 1
+        # Condition type -> handler that writes it into the Conditions dict
+        self._condition_handlers = {
+            'user': self._add_user_condition,
+            'user-group': self._add_user_group_condition,
+            'user-role': self._add_user_role_condition,
+            'app': self._add_app_condition,
+            'platform': self._add_platform_condition,
+            'device': self._add_device_condition,
+            'location': self._add_location_condition,
+            'client': self._add_client_condition,
+            'signin-risk': self._add_signin_risk_condition,
+            'user-risk': self._add_user_risk_condition,
+        }
     
     def optimize(self, paths: List[PolicyPath]) -> List[Dict[str, Any]]:
         """
@@ -376,42 +529,38 @@ class PolicyOptimizer:
         
         # Step 2: Optimize each cluster
         optimized_policies = []
-        for signature, cluster_paths in clusters.items():
-            merged_policy = self._merge_cluster(signature, cluster_paths)
+        for (signature, state), cluster_paths in clusters.items():
+            merged_policy = self._merge_cluster(signature, state, cluster_paths)
             optimized_policies.append(merged_policy)
         
         return optimized_policies
     
-    def _cluster_by_action(self, paths: List[PolicyPath]) -> Dict[str, List[PolicyPath]]:
-        """Group paths that have identical actions"""
+    def _cluster_by_action(self, paths: List[PolicyPath]) -> Dict[Tuple[ActionSignature, str], List[PolicyPath]]:
+        """Group paths that have identical actions, keyed by (signature, state)"""
         clusters = defaultdict(list)
         
         for path in paths:
-            signature = path.get_action_signature()
-            # Also include state in signature to keep report-only separate
-            full_signature = f"{signature}|STATE:{path.state}"
-            clusters[full_signature].append(path)
+            # Also key on state to keep report-only separate
+            clusters[(path.get_action_signature(), path.state)].append(path)
         
         return clusters
     
-    def _merge_cluster(self, signature: str, paths: List[PolicyPath]) -> Dict[str, Any]:
+    def _merge_cluster(self, signature: ActionSignature, state: str, paths: List[PolicyPath]) -> Dict[str, Any]:
         """
         Merge all paths in a cluster into a single optimized policy
         Strategy: Union conditions of the same type
         """
-        # Extract state from signature
-        state = 'enabled'
-        if '|STATE:' in signature:
-            parts = signature.split('|STATE:')
-            signature = parts[0]
-            state = parts[1]
-        
-        # Collect all conditions by type
+        # Collect all conditions by type; paths sharing an IF prefix (or repeating a
+        # condition) carry equal conditions, which merge the same way as one copy
         condition_groups = defaultdict(list)
+        seen = set()
         
         for path in paths:
             for cond in path.conditions:
-                condition_groups[cond.type].append(cond)
+                key = (cond.type, cond.operator, cond.value, cond.guid, cond.is_negated)
+                if key not in seen:
+                    seen.add(key)
+                    condition_groups[cond.type].append(cond)
         
         # Merge conditions - for now, take union of values for each type
         merged_conditions = []
@@ -433,10 +582,11 @@ class PolicyOptimizer:
         if not conditions:
             return []
         
-        # Types that can have multiple values in CA policies
-        list_capable_types = {'platform', 'location', 'client', 'app'}
+        # A lone single-valued condition merges to itself (common case: skip the set/split)
+        if len(conditions) == 1 and conditions[0].operator != 'is-or':
+            return [conditions[0]]
         
-        if cond_type in list_capable_types:
+        if cond_type in LIST_CAPABLE_TYPES:
             # Collect all unique values
             values = set()
             for cond in conditions:
@@ -458,16 +608,15 @@ class PolicyOptimizer:
         
         # For user groups/roles, collect all unique GUIDs
         if cond_type in {'user-group', 'user-role'}:
-            unique_guids = set()
+            # First condition seen for each GUID (source of display name and negation)
+            first_by_guid = {}
             for cond in conditions:
-                if cond.guid:
-                    unique_guids.add(cond.guid)
+                if cond.guid and cond.guid not in first_by_guid:
+                    first_by_guid[cond.guid] = cond
             
             # Return separate conditions for each
             result = []
-            for guid in unique_guids:
-                # Find original condition to get display name
-                orig = next((c for c in conditions if c.guid == guid), conditions[0])
+            for guid, orig in first_by_guid.items():
                 result.append(Condition(
                     type=cond_type,
                     operator='in',
@@ -486,12 +635,17 @@ class PolicyOptimizer:
         policy_name = f"Generated-Policy-{self.policy_counter}"
         self.policy_counter += 1
         
+        # Bucket actions by type once for the grant and session builders
+        actions_by_type = defaultdict(list)
+        for action in actions:
+            actions_by_type[action.type].append(action)
+        
         policy = {
             'DisplayName': policy_name,
             'State': state,
             'Conditions': self._build_conditions_dict(conditions),
-            'GrantControls': self._build_grant_controls(actions),
-            'SessionControls': self._build_session_controls(actions)
+            'GrantControls': self._build_grant_controls(actions_by_type),
+            'SessionControls': self._build_session_controls(actions_by_type)
         }
         
         # Remove empty sections
@@ -504,117 +658,92 @@ class PolicyOptimizer:
     
     def _build_conditions_dict(self, conditions: List[Condition]) -> Dict[str, Any]:
         """Build conditions dictionary"""
-        cond_dict = {
-            'Users': {},
-            'Applications': {},
-            'Platforms': {},
-            'Locations': {},
-            'ClientAppTypes': {},
-            'DeviceStates': {},
-            'SignInRiskLevels': [],
-            'UserRiskLevels': []
-        }
+        # Sections are created on first use; see CONDITION_SECTIONS for output order
+        cond_dict = defaultdict(dict)
+        handlers = self._condition_handlers
         
         for cond in conditions:
-            if cond.type == 'user':
-                if cond.value == 'All':
-                    cond_dict['Users']['IncludeUsers'] = ['All']
-                elif cond.value == 'Guest':
-                    cond_dict['Users']['IncludeGuestOrExternalUserTypes'] = ['internalGuest', 'b2bCollaborationGuest']
-            
-            elif cond.type == 'user-group':
-                if cond.is_negated:
-                    if 'ExcludeGroups' not in cond_dict['Users']:
-                        cond_dict['Users']['ExcludeGroups'] = []
-                    cond_dict['Users']['ExcludeGroups'].append(cond.guid)
-                else:
-                    if 'IncludeGroups' not in cond_dict['Users']:
-                        cond_dict['Users']['IncludeGroups'] = []
-                    cond_dict['Users']['IncludeGroups'].append(cond.guid)
-            
-            elif cond.type == 'user-role':
-                if 'IncludeRoles' not in cond_dict['Users']:
-                    cond_dict['Users']['IncludeRoles'] = []
-                cond_dict['Users']['IncludeRoles'].append(cond.guid)
-            
-            elif cond.type == 'app':
-                if cond.value == 'All':
-                    cond_dict['Applications']['IncludeApplications'] = ['All']
-                elif cond.value == 'Office365':
-                    cond_dict['Applications']['IncludeApplications'] = ['Office365']
-                elif cond.guid:
-                    if 'IncludeApplications' not in cond_dict['Applications']:
-                        cond_dict['Applications']['IncludeApplications'] = []
-                    cond_dict['Applications']['IncludeApplications'].append(cond.guid)
-            
-            elif cond.type == 'platform':
-                if cond.operator == 'is-or':
-                    platforms = cond.value.split('|')
-                    cond_dict['Platforms']['IncludePlatforms'] = platforms
-                else:
-                    if 'IncludePlatforms' not in cond_dict['Platforms']:
-                        cond_dict['Platforms']['IncludePlatforms'] = []
-                    cond_dict['Platforms']['IncludePlatforms'].append(cond.value)
-            
-            elif cond.type == 'device':
-                # Device conditions like Compliant, HybridJoined
-                # In Graph API, these would be deviceStates filters or grant controls
-                # For now, we'll note them but may need special handling
-                if cond.value == 'Compliant':
-                    # This could be a filter expression in production
-                    cond_dict['DeviceStates']['CompliantDevice'] = True
-                elif cond.value == 'HybridJoined':
-                    cond_dict['DeviceStates']['DomainJoinedDevice'] = True
-            
-            elif cond.type == 'location':
-                if cond.value == 'Trusted':
-                    if cond.is_negated:
-                        cond_dict['Locations']['ExcludeLocations'] = ['AllTrusted']
-                    else:
-                        cond_dict['Locations']['IncludeLocations'] = ['AllTrusted']
-                elif cond.value == 'All':
-                    cond_dict['Locations']['IncludeLocations'] = ['All']
-                elif cond.guid:
-                    if 'IncludeLocations' not in cond_dict['Locations']:
-                        cond_dict['Locations']['IncludeLocations'] = []
-                    cond_dict['Locations']['IncludeLocations'].append(cond.guid)
-            
-            elif cond.type == 'client':
-                if cond.operator == 'is-or':
-                    clients = cond.value.split('|')
-                    cond_dict['ClientAppTypes'] = self._map_client_types(clients)
-                else:
-                    cond_dict['ClientAppTypes'] = self._map_client_types([cond.value])
-            
-            elif cond.type == 'signin-risk':
-                cond_dict['SignInRiskLevels'].append(cond.value.lower())
-            
-            elif cond.type == 'user-risk':
-                cond_dict['UserRiskLevels'].append(cond.value.lower())
-        
-        # Clean up empty sections
-        for key in list(cond_dict.keys()):
-            if not cond_dict[key]:
-                del cond_dict[key]
-        
-        return cond_dict
+            handler = handlers.get(cond.type)
+            if handler:
+                handler(cond, cond_dict)
+        
+        # Keep non-empty sections only, in the fixed Graph section order
+        return {key: cond_dict[key] for key in CONDITION_SECTIONS if cond_dict.get(key)}
+    
+    def _add_user_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.value == 'All':
+            cond_dict['Users']['IncludeUsers'] = ['All']
+        elif cond.value == 'Guest':
+            cond_dict['Users']['IncludeGuestOrExternalUserTypes'] = ['internalGuest', 'b2bCollaborationGuest']
+    
+    def _add_user_group_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.is_negated:
+            cond_dict['Users'].setdefault('ExcludeGroups', []).append(cond.guid)
+        else:
+            cond_dict['Users'].setdefault('IncludeGroups', []).append(cond.guid)
+    
+    def _add_user_role_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        cond_dict['Users'].setdefault('IncludeRoles', []).append(cond.guid)
+    
+    def _add_app_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.value == 'All':
+            cond_dict['Applications']['IncludeApplications'] = ['All']
+        elif cond.value == 'Office365':
+            cond_dict['Applications']['IncludeApplications'] = ['Office365']
+        elif cond.guid:
+            cond_dict['Applications'].setdefault('IncludeApplications', []).append(cond.guid)
+    
+    def _add_platform_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.operator == 'is-or':
+            platforms = cond.value.split('|')
+            cond_dict['Platforms']['IncludePlatforms'] = platforms
+        else:
+            cond_dict['Platforms'].setdefault('IncludePlatforms', []).append(cond.value)
+    
+    def _add_device_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        # Device conditions like Compliant, HybridJoined
+        # In Graph API, these would be deviceStates filters or grant controls
+        # For now, we'll note them but may need special handling
+        if cond.value == 'Compliant':
+            # This could be a filter expression in production
+            cond_dict['DeviceStates']['CompliantDevice'] = True
+        elif cond.value == 'HybridJoined':
+            cond_dict['DeviceStates']['DomainJoinedDevice'] = True
+    
+    def _add_location_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.value == 'Trusted':
+            if cond.is_negated:
+                cond_dict['Locations']['ExcludeLocations'] = ['AllTrusted']
+            else:
+                cond_dict['Locations']['IncludeLocations'] = ['AllTrusted']
+        elif cond.value == 'All':
+            cond_dict['Locations']['IncludeLocations'] = ['All']
+        elif cond.guid:
+            cond_dict['Locations'].setdefault('IncludeLocations', []).append(cond.guid)
+    
+    def _add_client_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        if cond.operator == 'is-or':
+            clients = cond.value.split('|')
+            cond_dict['ClientAppTypes'] = self._map_client_types(clients)
+        else:
+            cond_dict['ClientAppTypes'] = self._map_client_types([cond.value])
+    
+    def _add_signin_risk_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        cond_dict.setdefault('SignInRiskLevels', []).append(cond.value.lower())
+    
+    def _add_user_risk_condition(self, cond: Condition, cond_dict: Dict[str, Any]):
+        cond_dict.setdefault('UserRiskLevels', []).append(cond.value.lower())
     
     def _map_client_types(self, client_values: List[str]) -> List[str]:
         """Map client types to Entra values"""
-        mapping = {
-            'Browser': 'browser',
-            'MobileApp': 'mobileAppsAndDesktopClients',
-            'DesktopApp': 'mobileAppsAndDesktopClients',
-            'ExchangeActiveSync': 'exchangeActiveSync',
-            'Other': 'other'
-        }
-        return list(set(mapping.get(c, c.lower()) for c in client_values))
+        # Fresh list per call: a shared list would be written as a YAML alias
+        return list(_map_client_types_cached(frozenset(client_values)))
     
-    def _build_grant_controls(self, actions: List[Action]) -> Dict[str, Any]:
+    def _build_grant_controls(self, actions_by_type: Dict[str, List[Action]]) -> Dict[str, Any]:
         """Build grant controls dictionary"""
-        grant_actions = [a for a in actions if a.type == 'REQUIRE']
-        block_actions = [a for a in actions if a.type == 'BLOCK']
-        allow_actions = [a for a in actions if a.type == 'ALLOW']
+        grant_actions = actions_by_type['REQUIRE']
+        block_actions = actions_by_type['BLOCK']
+        allow_actions = actions_by_type['ALLOW']
         
         if block_actions:
             return {
@@ -656,19 +785,11 @@ class PolicyOptimizer:
     
     def _map_grant_control(self, control: str) -> str:
         """Map grant control to Entra value"""
-        mapping = {
-            'MFA': 'mfa',
-            'CompliantDevice': 'compliantDevice',
-            'HybridJoined': 'domainJoinedDevice',
-            'ApprovedApp': 'approvedApplication',
-            'AppProtection': 'compliantApplication',
-            'PasswordChange': 'passwordChange'
-        }
-        return mapping.get(control, control.lower())
+        return GRANT_CONTROL_MAP.get(control, control.lower())
     
-    def _build_session_controls(self, actions: List[Action]) -> Dict[str, Any]:
+    def _build_session_controls(self, actions_by_type: Dict[str, List[Action]]) -> Dict[str, Any]:
         """Build session controls dictionary"""
-        session_actions = [a for a in actions if a.type == 'SESSION']
+        session_actions = actions_by_type['SESSION']
         
         if not session_actions:
             return {}
@@ -683,7 +804,7 @@ class PolicyOptimizer:
             value = action.value.strip()
             
             # signin-frequency 1 hours
-            if m := re.match(r'signin-frequency\s+(\d+)\s+(hours?|days?)', value, re.IGNORECASE):
+            if m := SESSION_SIGNIN_FREQUENCY_RE.match(value):
                 num = int(m.group(1))
                 unit = m.group(2).lower()
                 session_controls['SignInFrequency'] = {
@@ -693,7 +814,7 @@ class PolicyOptimizer:
                 }
             
             # persistent-browser always|never
-            elif m := re.match(r'persistent-browser\s+(always|never)', value, re.IGNORECASE):
+            elif m := SESSION_PERSISTENT_BROWSER_RE.match(value):
                 mode = m.group(1).lower()
                 session_controls['PersistentBrowser'] = {
                     'Mode': mode,
@@ -729,64 +850,53 @@ class PathExtractor:
         
         return all_paths
     
-    def _extract_paths_from_statement(
-        self, 
-        stmt: IfStatement, 
-        parent_conditions: Optional[List[Condition]] = None
-    ) -> List[PolicyPath]:
+    def _extract_paths_from_statement(self, stmt: IfStatement) -> List[PolicyPath]:
         """
         Extract all unique paths through an IF-ELSE tree
-        Uses depth-first traversal with condition accumulation
+        Uses depth-first traversal with condition accumulation: an explicit stack of
+        (branch, depth) pairs and one shared condition list truncated back to each
+        branch's parent depth, instead of recursing and concatenating lists
         """
-        if parent_conditions is None:
-            parent_conditions = []
-        
         paths = []
+        current_conditions: List[Condition] = []
         
-        # Process IF branch
-        if_conditions = parent_conditions + stmt.if_branch.conditions
-        
-        if stmt.if_branch.nested_if:
-            # Nested IF - recurse deeper
-            paths.extend(self._extract_paths_from_statement(stmt.if_branch.nested_if, if_conditions))
-        else:
-            # Leaf node - create path
-            path = PolicyPath(
-                conditions=if_conditions[:],  # Copy list
-                actions=stmt.if_branch.actions[:],
-                state=stmt.if_branch.state
-            )
-            paths.append(path)
-        
-        # Process ELSE IF branches
-        for else_if_branch in stmt.else_if_branches:
-            branch_conditions = parent_conditions + else_if_branch.conditions
-            
-            if else_if_branch.nested_if:
-                paths.extend(self._extract_paths_from_statement(else_if_branch.nested_if, branch_conditions))
-            else:
-                path = PolicyPath(
-                    conditions=branch_conditions[:],
-                    actions=else_if_branch.actions[:],
-                    state=else_if_branch.state
-                )
-                paths.append(path)
+        # Branches are pushed in reverse so they pop in IF, ELSE IF..., ELSE order
+        stack = [(branch, 0) for branch in reversed(self._branches(stmt))]
         
-        # Process ELSE branch
-        if stmt.else_branch:
-            else_conditions = parent_conditions + stmt.else_branch.conditions
+        while stack:
+            branch, depth = stack.pop()
+            del current_conditions[depth:]
+            current_conditions.extend(branch.conditions)
             
-            if stmt.else_branch.nested_if:
-                paths.extend(self._extract_paths_from_statement(stmt.else_branch.nested_if, else_conditions))
+            if branch.nested_if:
+                # Nested IF - descend with this branch's conditions as the prefix
+                depth = len(current_conditions)
+                stack.extend((child, depth) for child in reversed(self._branches(branch.nested_if)))
             else:
+                # Leaf node - create path
                 path = PolicyPath(
-                    conditions=else_conditions[:],
-                    actions=stmt.else_branch.actions[:],
-                    state=stmt.else_branch.state
+                    conditions=tuple(current_conditions),  # Snapshot of the shared list
+                    actions=branch.actions,
+                    state=branch.state
                 )
                 paths.append(path)
         
         return paths
+    
+    @staticmethod
+    def _branches(stmt: IfStatement) -> List[PolicyBranch]:
+        """IF, ELSE IF and ELSE branches of a statement, in source order"""
+        branches = [stmt.if_branch]
+        branches.extend(stmt.else_if_branches)
+        if stmt.else_branch:
+            branches.append(stmt.else_branch)
+        return branches
+
+
+def write_policy_yaml(output_path: Path, policy: Dict[str, Any]):
+    """Write one generated policy as YAML"""
+    with open(output_path, 'w', encoding='utf-8') as f:
+        yaml.dump(policy, f, Dumper=YAML_DUMPER, default_flow_style=False, sort_keys=False, allow_unicode=True)
 
 
 def main():
@@ -857,13 +967,13 @@ def main():
     # Save policies
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    for i, policy in enumerate(policies, 1):
-        filename = f"Policy-{i:03d}-{timestamp}.yaml"
-        output_path = output_folder / filename
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            yaml.dump(policy, f, default_flow_style=False, sort_keys=False, allow_unicode=True)
-        
+    filenames = [f"Policy-{i:03d}-{timestamp}.yaml" for i in range(1, len(policies) + 1)]
+    
+    # Emit and write files concurrently; report them in order once all are written
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write_policy_yaml, (output_folder / name for name in filenames), policies))
+    
+    for filename in filenames:
         print(f"  ✓ {filename}")
     
     print()
@@ -3,20 +3,54 @@ Interactive Conditional Access Policy Visualizer
 Uses "What If" evaluation to show effective controls for all combinations
 """
 
+import os
+import sys
+import gzip
+import hashlib
 import yaml
+import orjson
 from pathlib import Path
-from typing import List, Dict, Any, Set, Tuple
+from typing import List, Dict, Any, Set, Tuple, Optional, FrozenSet, Sequence
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import plotly.graph_objects as go
 from collections import defaultdict
 import itertools
 
+# libyaml's C parser when PyYAML was built with it (the PyPI wheels are), else pure Python
+try:
+    from yaml import CSafeLoader as YAML_LOADER
+except ImportError:
+    from yaml import SafeLoader as YAML_LOADER
+
+# Also write a gzip-compressed copy of the HTML (<name>.html.gz), opt-in via CAPL_HTML_GZIP=1
+WRITE_GZIP = os.environ.get('CAPL_HTML_GZIP') == '1'
+
+# Opt-in: leave out matrix rows/columns where no policy applies (listed on the console instead)
+PRUNE_UNMATCHED = os.environ.get('CAPL_PRUNE_UNMATCHED') == '1'
+
 
 class PolicyParser:
     """Parse and extract dimensions from policies"""
     
-    def __init__(self, policies: List[Dict[str, Any]]):
+    def __init__(self, policies: List[Dict[str, Any]], dimensions: Optional[Dict[str, Set[str]]] = None):
         self.policies = policies
-        self.dimensions = {
+        # Dimensions may come pre-extracted from scan_policies() (single pass shared with compilation)
+        self.dimensions = dimensions if dimensions is not None else self._extract_dimensions(policies)
+    
+    @staticmethod
+    def _extract_dimensions(policies: List[Dict[str, Any]]) -> Dict[str, Set[str]]:
+        """Extract all unique values mentioned in policies ('All'-style wildcards excluded)"""
+        dimensions = PolicyParser._new_dimensions()
+        for policy in policies:
+            PolicyParser._add_policy_dimensions(dimensions, policy)
+        PolicyParser._add_default_dimensions(dimensions)
+        return dimensions
+    
+    @staticmethod
+    def _new_dimensions() -> Dict[str, Set[str]]:
+        return {
             'users': set(),
             'applications': set(),
             'platforms': set(),
@@ -25,63 +59,46 @@ class PolicyParser:
             'user_risks': set(),
             'signin_risks': set()
         }
-        self._extract_dimensions()
     
-    def _extract_dimensions(self):
-        """Extract all unique values mentioned in policies"""
-        for policy in self.policies:
-            conditions = policy.get('Conditions', {})
-            
-            # Users
-            users = conditions.get('Users', {})
-            if 'IncludeUsers' in users:
-                for user in users['IncludeUsers']:
-                    if user != 'All':
-                        self.dimensions['users'].add(user)
-            if 'IncludeGroups' in users:
-                self.dimensions['users'].update(users['IncludeGroups'])
-            
-            # Applications
-            apps = conditions.get('Applications', {})
-            if 'IncludeApplications' in apps:
-                for app in apps['IncludeApplications']:
-                    if app != 'All':
-                        self.dimensions['applications'].add(app)
-            
-            # Platforms
-            platforms = conditions.get('Platforms', {})
-            if 'IncludePlatforms' in platforms:
-                for plat in platforms['IncludePlatforms']:
-                    if plat != 'all':
-                        self.dimensions['platforms'].add(plat)
-            
-            # Locations
-            locations = conditions.get('Locations', {})
-            if 'IncludeLocations' in locations:
-                for loc in locations['IncludeLocations']:
-                    if loc not in ['All', 'AllTrusted']:
-                        self.dimensions['locations'].add(loc)
-            
-            # Client types
-            if 'ClientAppTypes' in conditions:
-                self.dimensions['client_types'].update(conditions['ClientAppTypes'])
-            
-            # Risks
-            if 'UserRiskLevels' in conditions:
-                self.dimensions['user_risks'].update(conditions['UserRiskLevels'])
-            if 'SignInRiskLevels' in conditions:
-                self.dimensions['signin_risks'].update(conditions['SignInRiskLevels'])
-        
-        # Add generic/default values if sets are empty
-        if not self.dimensions['users']:
-            self.dimensions['users'].add('GenericUser')
-        if not self.dimensions['platforms']:
-            self.dimensions['platforms'] = {'windows', 'iOS', 'android', 'macOS'}
+    @staticmethod
+    def _add_policy_dimensions(dimensions: Dict[str, Set[str]], policy: Dict[str, Any]):
+        """Add the values one policy mentions to the dimension sets"""
+        conditions = policy.get('Conditions') or {}
+        
+        # Users
+        users = conditions.get('Users') or {}
+        dimensions['users'] |= set(users.get('IncludeUsers', ())) - {'All'}
+        dimensions['users'].update(users.get('IncludeGroups', ()))
+        
+        # Applications
+        apps = conditions.get('Applications') or {}
+        dimensions['applications'] |= set(apps.get('IncludeApplications', ())) - {'All'}
+        
+        # Platforms
+        platforms = conditions.get('Platforms') or {}
+        dimensions['platforms'] |= set(platforms.get('IncludePlatforms', ())) - {'all'}
+        
+        # Locations
+        locations = conditions.get('Locations') or {}
+        dimensions['locations'] |= set(locations.get('IncludeLocations', ())) - {'All', 'AllTrusted'}
+        
+        # Client types
+        dimensions['client_types'].update(conditions.get('ClientAppTypes') or ())
+        
+        # Risks
+        dimensions['user_risks'].update(conditions.get('UserRiskLevels') or ())
+        dimensions['signin_risks'].update(conditions.get('SignInRiskLevels') or ())
+    
+    @staticmethod
+    def _add_default_dimensions(dimensions: Dict[str, Set[str]]):
+        """Add generic/default values if sets are empty"""
+        if not dimensions['users']:
+            dimensions['users'].add('GenericUser')
+        if not dimensions['platforms']:
+            dimensions['platforms'] = {'windows', 'iOS', 'android', 'macOS'}
         
         # Always include GenericApp to test catch-all scenarios
-        self.dimensions['applications'].add('GenericApp')
-        if not self.dimensions['applications']:
-            self.dimensions['applications'].add('GenericApp')
+        dimensions['applications'].add('GenericApp')
     
     def get_top_dimensions(self, max_values: int = 5) -> Dict[str, List[str]]:
         """Get most important dimensions for visualization"""
@@ -109,205 +126,353 @@ class PolicyParser:
         return result
 
 
+# Compiled policy records are read once per grid row/column: use __slots__ where
+# dataclasses support it (Python 3.10+)
+DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+# Scenario client types as bits, so a policy's ClientAppTypes compiles to one mask
+CLIENT_TYPE_BITS = {'Browser': 1, 'Mobile/Desktop': 2, 'Legacy': 4}
+
+
+# Heatmap cell codes (int8 z values, mapped to colors by a 0..2 colorscale)
+CELL_BLOCK, CELL_CONTROLS, CELL_ALLOW = 0, 1, 2
+
+# Grant controls that decide the effective action label, as bits
+CONTROL_BITS = {'mfa': 1, 'compliantDevice': 2, 'domainJoinedDevice': 4}
+
+# Action label by combined control bits (in priority order: MFA+Compliant, MFA,
+# CompliantDevice, DomainJoined); 0 falls back to Session / Multiple Controls
+CONTROL_ACTIONS = {
+    0b001: 'MFA', 0b011: 'MFA+Compliant', 0b101: 'MFA', 0b111: 'MFA+Compliant',
+    0b010: 'CompliantDevice', 0b110: 'CompliantDevice',
+    0b100: 'DomainJoined',
+}
+
+
+@dataclass(**DATACLASS_SLOTS)
+class CompiledPolicy:
+    """Policy conditions and controls extracted once for repeated scenario matching"""
+    display_name: Any
+    client_mask: Optional[int]                # None: any client type
+    compliant_ok: bool                        # device state checks, precomputed per state
+    unmanaged_ok: bool
+    user_risks: Optional[FrozenSet[str]]      # None: no user risk condition
+    signin_risks: Optional[FrozenSet[str]]    # None: no sign-in risk condition
+    all_users: bool
+    include_users: FrozenSet[Any]             # IncludeUsers + IncludeGroups
+    exclude_users: FrozenSet[Any]             # ExcludeUsers + ExcludeGroups
+    all_apps: bool
+    include_apps: FrozenSet[Any]
+    exclude_apps: FrozenSet[Any]
+    platforms: Optional[FrozenSet[Any]]       # None: any platform
+    trusted_ok: bool                          # location checks, precomputed per location
+    untrusted_ok: bool
+    is_block: bool
+    grant_controls: List[str]
+    control_bits: int                         # CONTROL_BITS of grant_controls
+    session_controls: List[str]
+
+
+# Per-field condition checks, in the order of GridEvaluator's encoded row
+# (user, platform, is_compliant, user_risk, signin_risk) and column (app, location, client_bit)
+
+def _user_matches(policy: CompiledPolicy, user: str) -> bool:
+    return user not in policy.exclude_users and (policy.all_users or user in policy.include_users)
+
+
+def _platform_matches(policy: CompiledPolicy, platform: Optional[str]) -> bool:
+    # None: platform not part of the scenario, not checked
+    return platform is None or policy.platforms is None or platform in policy.platforms
+
+
+def _device_matches(policy: CompiledPolicy, is_compliant: bool) -> bool:
+    return policy.compliant_ok if is_compliant else policy.unmanaged_ok
+
+
+def _user_risk_matches(policy: CompiledPolicy, risk: str) -> bool:
+    # A policy that requires risk never matches 'no risk'
+    return policy.user_risks is None or (risk != 'no risk' and risk in policy.user_risks)
+
+
+def _signin_risk_matches(policy: CompiledPolicy, risk: str) -> bool:
+    return policy.signin_risks is None or (risk != 'no risk' and risk in policy.signin_risks)
+
+
+def _app_matches(policy: CompiledPolicy, app: str) -> bool:
+    return app not in policy.exclude_apps and (policy.all_apps or app in policy.include_apps)
+
+
+def _location_matches(policy: CompiledPolicy, location: Optional[str]) -> bool:
+    if location == 'Trusted':
+        return policy.trusted_ok
+    if location == 'Untrusted':
+        return policy.untrusted_ok
+    return True
+
+
+def _client_matches(policy: CompiledPolicy, client_bit: int) -> bool:
+    return policy.client_mask is None or bool(policy.client_mask & client_bit)
+
+
+ROW_FIELD_CHECKS = (_user_matches, _platform_matches, _device_matches, _user_risk_matches, _signin_risk_matches)
+COLUMN_FIELD_CHECKS = (_app_matches, _location_matches, _client_matches)
+
+
 class GridEvaluator:
     """Evaluate policies against all possible scenarios"""
     
-    def __init__(self, policies: List[Dict[str, Any]]):
+    def __init__(self, policies: List[Dict[str, Any]], compiled: Optional[List[CompiledPolicy]] = None):
         self.policies = policies
+        # Compiled policies may come from scan_policies() (single pass shared with dimension extraction)
+        self._compiled = compiled if compiled is not None else self._compile_policies()
     
-    def _matches_condition(self, policy: Dict[str, Any], scenario: Dict[str, str]) -> bool:
-        """Check if policy applies to given scenario"""
-        conditions = policy.get('Conditions', {})
+    def _compile_policies(self) -> List[CompiledPolicy]:
+        """Read each policy's YAML structure once into a CompiledPolicy"""
+        return [self._compile_policy(policy) for policy in self.policies]
+    
+    @staticmethod
+    def _compile_policy(policy: Dict[str, Any]) -> CompiledPolicy:
+        # Read every section once up front; a missing or null section counts as empty
+        conditions = policy.get('Conditions') or {}
+        users = conditions.get('Users') or {}
+        apps = conditions.get('Applications') or {}
+        platforms = conditions.get('Platforms') or {}
+        locations = conditions.get('Locations') or {}
+        device_states = conditions.get('DeviceStates') or {}
+        client_types = conditions.get('ClientAppTypes')
+        user_risk_levels = conditions.get('UserRiskLevels')      # None: no risk condition
+        signin_risk_levels = conditions.get('SignInRiskLevels')  # None: no risk condition
+        grant_controls = policy.get('GrantControls') or {}
+        session = policy.get('SessionControls') or {}
         
         # CRITICAL: If policy has conditions we're not modeling in our scenarios,
         # we should NOT match it (it's conditional on things we're not showing)
         # This prevents "All users + All apps + SignInRisk=high -> BLOCK" from blocking everything
         
-        # Check Client Types
-        if 'ClientAppTypes' in conditions:
-            policy_types = conditions['ClientAppTypes']
-            # If policy has 'all', it matches everything
-            if policy_types and 'all' not in policy_types:
-                scenario_client = scenario.get('client_type', 'Browser')
-                
-                # Map scenario to policy values
-                match = False
-                if scenario_client == 'Browser' and 'browser' in policy_types:
-                    match = True
-                elif scenario_client == 'Mobile/Desktop' and 'mobileAppsAndDesktopClients' in policy_types:
-                    match = True
-                elif scenario_client == 'Legacy' and ('exchangeActiveSync' in policy_types or 'otherClients' in policy_types):
-                    match = True
-                
-                if not match:
-                    return False
-
-        # Device states: NOW MODELED - check if it matches scenario
-        if 'DeviceStates' in conditions:
-            device_states = conditions['DeviceStates']
+        # Client Types: 'all' (or an empty list) matches everything
+        client_mask = None
+        if client_types and 'all' not in client_types:
+            client_mask = 0
+            if 'browser' in client_types:
+                client_mask |= CLIENT_TYPE_BITS['Browser']
+            if 'mobileAppsAndDesktopClients' in client_types:
+                client_mask |= CLIENT_TYPE_BITS['Mobile/Desktop']
+            if 'exchangeActiveSync' in client_types or 'otherClients' in client_types:
+                client_mask |= CLIENT_TYPE_BITS['Legacy']
+        
+        # Device states: Azure AD uses 'Compliant', 'DomainJoined', 'All'
+        # We simplify to: 'Compliant' (managed) or 'Unmanaged' (BYOD)
+        compliant_ok = unmanaged_ok = True
+        if device_states:
             include_states = device_states.get('IncludeStates', [])
             exclude_states = device_states.get('ExcludeStates', [])
+            managed_included = 'Compliant' in include_states or 'DomainJoined' in include_states
             
-            # Map our simplified states to Azure AD DeviceStates
-            scenario_state = scenario.get('device_state', 'Unmanaged')
-            
-            # Azure AD uses: 'Compliant', 'DomainJoined', 'All'
-            # We simplify to: 'Compliant' (managed) or 'Unmanaged' (BYOD)
-            if scenario_state == 'Compliant':
-                # Compliant devices are considered domain-joined/managed
-                if exclude_states and ('Compliant' in exclude_states or 'DomainJoined' in exclude_states):
-                    return False
-                if include_states and 'All' not in include_states:
-                    if 'Compliant' not in include_states and 'DomainJoined' not in include_states:
-                        return False
-            else:  # Unmanaged
-                # Unmanaged means NOT compliant, NOT domain-joined
-                if include_states and ('Compliant' in include_states or 'DomainJoined' in include_states):
-                    # Policy requires compliant/domain-joined, but we're unmanaged
-                    return False
-        
-        # User Risk
-        if 'UserRiskLevels' in conditions:
-            policy_risks = [r.lower() for r in conditions['UserRiskLevels']]
-            scenario_risk = scenario.get('user_risk', 'No Risk').lower()
-            
-            if scenario_risk == 'no risk':
-                # Policy requires risk, but we have none -> No match
-                return False
-            
-            # If scenario is 'high', it matches if 'high' (or 'medium'/'low' if we want to be strict, but usually high covers high)
-            # For now, exact match on 'high'
-            if scenario_risk not in policy_risks:
-                return False
-
-        # Sign-in Risk
-        if 'SignInRiskLevels' in conditions:
-            policy_risks = [r.lower() for r in conditions['SignInRiskLevels']]
-            scenario_risk = scenario.get('signin_risk', 'No Risk').lower()
-            
-            if scenario_risk == 'no risk':
-                return False
-            
-            if scenario_risk not in policy_risks:
-                return False
-        
-        # Now check the conditions we DO model
-        
-        # Check Users
-        users = conditions.get('Users', {})
+            # Compliant devices are considered domain-joined/managed
+            if exclude_states and ('Compliant' in exclude_states or 'DomainJoined' in exclude_states):
+                compliant_ok = False
+            if include_states and 'All' not in include_states and not managed_included:
+                compliant_ok = False
+            # Unmanaged means NOT compliant, NOT domain-joined
+            if include_states and managed_included:
+                unmanaged_ok = False
+        
+        # Risks: a policy that requires risk never matches the 'No Risk' scenarios
+        user_risks = None
+        if user_risk_levels is not None:
+            user_risks = frozenset(r.lower() for r in user_risk_levels)
+        signin_risks = None
+        if signin_risk_levels is not None:
+            signin_risks = frozenset(r.lower() for r in signin_risk_levels)
+        
+        # Users
         include_users = users.get('IncludeUsers', [])
-        exclude_users = users.get('ExcludeUsers', [])
-        include_groups = users.get('IncludeGroups', [])
-        exclude_groups = users.get('ExcludeGroups', [])
-        
-        user_match = (
-            'All' in include_users or
-            scenario['user'] in include_users or
-            scenario['user'] in include_groups
-        )
-        
-        if scenario['user'] in exclude_users or scenario['user'] in exclude_groups:
-            return False
         
-        if not user_match:
-            return False
-        
-        # Check Applications
-        apps = conditions.get('Applications', {})
+        # Applications
         include_apps = apps.get('IncludeApplications', [])
-        exclude_apps = apps.get('ExcludeApplications', [])
         
-        app_match = (
-            'All' in include_apps or
-            scenario['application'] in include_apps
+        # Platforms
+        platform_set = None
+        if platforms:
+            include_plats = platforms.get('IncludePlatforms', [])
+            if include_plats and 'all' not in include_plats:
+                platform_set = frozenset(include_plats)
+        
+        # Locations
+        trusted_ok = untrusted_ok = True
+        if locations:
+            include_locs = locations.get('IncludeLocations', [])
+            exclude_locs = locations.get('ExcludeLocations', [])
+            if exclude_locs and 'AllTrusted' in exclude_locs:
+                trusted_ok = False
+            if include_locs and 'All' not in include_locs and 'AllTrusted' not in include_locs:
+                trusted_ok = False
+            if include_locs and 'AllTrusted' in include_locs:
+                untrusted_ok = False
+        
+        # Grant controls
+        built_in = grant_controls.get('BuiltInControls', [])
+        
+        # Session controls
+        session_controls = []
+        if session:
+            if session.get('ApplicationEnforcedRestrictions', {}).get('IsEnabled'):
+                session_controls.append('App Restrictions')
+            if session.get('CloudAppSecurity', {}).get('IsEnabled'):
+                session_controls.append('Conditional Access App Control')
+            if session.get('SignInFrequency', {}).get('IsEnabled'):
+                freq = session['SignInFrequency']
+                session_controls.append(f"Sign-in Frequency: {freq.get('Value', '?')} {freq.get('Type', 'hours')}")
+            if session.get('PersistentBrowser', {}).get('IsEnabled'):
+                mode = session['PersistentBrowser'].get('Mode', 'never')
+                session_controls.append(f"Persistent Browser: {mode}")
+        
+        return CompiledPolicy(
+            display_name=policy.get('DisplayName'),
+            client_mask=client_mask,
+            compliant_ok=compliant_ok,
+            unmanaged_ok=unmanaged_ok,
+            user_risks=user_risks,
+            signin_risks=signin_risks,
+            all_users='All' in include_users,
+            include_users=frozenset(include_users) | frozenset(users.get('IncludeGroups', [])),
+            exclude_users=frozenset(users.get('ExcludeUsers', [])) | frozenset(users.get('ExcludeGroups', [])),
+            all_apps='All' in include_apps,
+            include_apps=frozenset(include_apps),
+            exclude_apps=frozenset(apps.get('ExcludeApplications', [])),
+            platforms=platform_set,
+            trusted_ok=trusted_ok,
+            untrusted_ok=untrusted_ok,
+            is_block='block' in built_in,
+            grant_controls=list(built_in),
+            control_bits=sum(bit for control, bit in CONTROL_BITS.items() if control in built_in),
+            session_controls=session_controls,
+        )
+    
+    @staticmethod
+    def _encode_row(scenario: Dict[str, str]) -> Tuple:
+        """Identity-side fields as (user, platform, is_compliant, user_risk, signin_risk)"""
+        return (
+            scenario['user'],
+            scenario.get('platform'),   # None: not part of the scenario, not checked
+            scenario.get('device_state', 'Unmanaged') == 'Compliant',
+            scenario.get('user_risk', 'No Risk').lower(),
+            scenario.get('signin_risk', 'No Risk').lower(),
+        )
+    
+    @staticmethod
+    def _encode_column(scenario: Dict[str, str]) -> Tuple:
+        """Resource-side fields as (app, location, client_bit)"""
+        return (
+            scenario['application'],
+            scenario.get('location'),   # None: not part of the scenario, not checked
+            CLIENT_TYPE_BITS.get(scenario.get('client_type', 'Browser'), 0),
+        )
+    
+    def match_grid(self, rows: List[Dict[str, str]], columns: List[Dict[str, str]]) -> np.ndarray:
+        """
+        Boolean array [policy, row, column]: does each policy apply to each row × column scenario
+        Row and column conditions are independent, so each policy's grid is the outer AND of
+        one vector over rows and one over columns
+        """
+        row_ok = self._match_fields([self._encode_row(row) for row in rows], ROW_FIELD_CHECKS, self._compiled)
+        
+        # Fail fast per policy: one that matches no row (typically excluded by its user/group
+        # condition, the most selective one) matches no cell, so its columns are never checked
+        live = np.flatnonzero(row_ok.any(axis=1))
+        column_ok = np.zeros((len(self._compiled), len(columns)), dtype=bool)
+        column_ok[live] = self._match_fields(
+            [self._encode_column(column) for column in columns],
+            COLUMN_FIELD_CHECKS,
+            [self._compiled[index] for index in live]
         )
         
-        if scenario['application'] in exclude_apps:
-            return False
-        
-        if not app_match:
-            return False
-        
-        # Check Platforms
-        if 'platform' in scenario:
-            platforms = conditions.get('Platforms', {})
-            if platforms:
-                include_plats = platforms.get('IncludePlatforms', [])
-                if include_plats and 'all' not in include_plats:
-                    if scenario['platform'] not in include_plats:
-                        return False
-        
-        # Check Locations
-        if 'location' in scenario:
-            locations = conditions.get('Locations', {})
-            if locations:
-                include_locs = locations.get('IncludeLocations', [])
-                exclude_locs = locations.get('ExcludeLocations', [])
-                
-                if scenario['location'] == 'Trusted':
-                    if exclude_locs and 'AllTrusted' in exclude_locs:
-                        return False
-                    if include_locs and 'All' not in include_locs and 'AllTrusted' not in include_locs:
-                        return False
-                elif scenario['location'] == 'Untrusted':
-                    if include_locs and 'AllTrusted' in include_locs:
-                        return False
+        return row_ok[:, :, None] & column_ok[:, None, :]
+    
+    @staticmethod
+    def _match_fields(encoded: List[Tuple], checks: Tuple, policies: List[CompiledPolicy]) -> np.ndarray:
+        """
+        Boolean array [policy, scenario] for encoded rows or columns
+        Each field check runs once per policy and *distinct* field value (a handful per axis);
+        the per-field tables are gathered back onto the scenarios by integer code and ANDed
+        """
+        result = np.ones((len(policies), len(encoded)), dtype=bool)
+        
+        for field, check in enumerate(checks):
+            value_codes: Dict[Any, int] = {}
+            codes = np.array([value_codes.setdefault(item[field], len(value_codes)) for item in encoded], dtype=np.intp)
+            table = np.array(
+                [[check(policy, value) for value in value_codes] for policy in policies],
+                dtype=bool
+            ).reshape(len(policies), len(value_codes))
+            result &= table[:, codes]
         
-        return True
+        return result
+    
+    @staticmethod
+    def match_classes(matches: np.ndarray) -> Tuple[List[Tuple[int, ...]], np.ndarray]:
+        """
+        Group match_grid() cells by the exact set of policies they match
+        Returns the distinct matched-index tuples and a [row, column] array of indices into them,
+        so per-result work runs once per behaviour class instead of once per cell
+        """
+        n_policies, n_rows, n_columns = matches.shape
+        classes, inverse = np.unique(
+            matches.reshape(n_policies, n_rows * n_columns).T, axis=0, return_inverse=True
+        )
+        matched_sets = [tuple(np.flatnonzero(cls).tolist()) for cls in classes]
+        return matched_sets, inverse.reshape(n_rows, n_columns)
+    
+    def color_values(self, matches: np.ndarray) -> np.ndarray:
+        """Per-cell int8 code from a match_grid() array: CELL_BLOCK, CELL_CONTROLS or CELL_ALLOW"""
+        is_block = np.array([policy.is_block for policy in self._compiled], dtype=bool)
+        # Non-blocking grant controls or any session controls put a cell on 'controls'
+        has_controls = np.array(
+            [(not policy.is_block and bool(policy.grant_controls)) or bool(policy.session_controls)
+             for policy in self._compiled],
+            dtype=bool
+        )
+        blocked = (matches & is_block[:, None, None]).any(axis=0)
+        controlled = (matches & has_controls[:, None, None]).any(axis=0)
+        codes = np.full(blocked.shape, CELL_ALLOW, dtype=np.int8)
+        codes[controlled] = CELL_CONTROLS
+        codes[blocked] = CELL_BLOCK
+        return codes
     
     def evaluate_scenario(self, scenario: Dict[str, str]) -> Dict[str, Any]:
-        """Evaluate what happens for a specific scenario"""
+        """Evaluate what happens for a specific scenario (a 1×1 match_grid)"""
+        matches = self.match_grid([scenario], [scenario])
+        return self.summarize(np.flatnonzero(matches[:, 0, 0]).tolist())
+    
+    def summarize(self, matched: Sequence[int]) -> Dict[str, Any]:
+        """Effective action, controls and policy names for the matched policy indices"""
         matched_policies = []
         is_blocked = False
         controls = []
+        control_bits = 0
         session_controls = []
         
-        # Check all policies
-        for policy in self.policies:
-            if self._matches_condition(policy, scenario):
-                matched_policies.append(policy['DisplayName'])
-                
-                # Extract grant controls
-                grant_controls = policy.get('GrantControls', {})
-                built_in = grant_controls.get('BuiltInControls', [])
-                
-                if 'block' in built_in:
-                    is_blocked = True
-                else:
-                    controls.extend(built_in)
-                
-                # Extract session controls
-                session = policy.get('SessionControls', {})
-                if session:
-                    if session.get('ApplicationEnforcedRestrictions', {}).get('IsEnabled'):
-                        session_controls.append('App Restrictions')
-                    if session.get('CloudAppSecurity', {}).get('IsEnabled'):
-                        session_controls.append('Conditional Access App Control')
-                    if session.get('SignInFrequency', {}).get('IsEnabled'):
-                        freq = session['SignInFrequency']
-                        session_controls.append(f"Sign-in Frequency: {freq.get('Value', '?')} {freq.get('Type', 'hours')}")
-                    if session.get('PersistentBrowser', {}).get('IsEnabled'):
-                        mode = session['PersistentBrowser'].get('Mode', 'never')
-                        session_controls.append(f"Persistent Browser: {mode}")
+        # Single pass: names, controls and the action-deciding bits together
+        for index in matched:
+            policy = self._compiled[index]
+            matched_policies.append(policy.display_name)
+            
+            if policy.is_block:
+                is_blocked = True
+            else:
+                controls.extend(policy.grant_controls)
+                control_bits |= policy.control_bits
+            
+            session_controls.extend(policy.session_controls)
         
         # Determine effective action
         if is_blocked:
             action = 'BLOCK'
             color_value = 0.0
         elif controls or session_controls:
-            unique_controls = list(set(controls))
-            if 'mfa' in unique_controls and 'compliantDevice' in unique_controls:
-                action = 'MFA+Compliant'
-            elif 'mfa' in unique_controls:
-                action = 'MFA'
-            elif 'compliantDevice' in unique_controls:
-                action = 'CompliantDevice'
-            elif 'domainJoinedDevice' in unique_controls:
-                action = 'DomainJoined'
-            elif session_controls and not unique_controls:
-                action = 'Session Controls'
-            else:
-                action = 'Multiple Controls'
+            action = CONTROL_ACTIONS.get(control_bits)
+            if action is None:
+                action = 'Session Controls' if not controls else 'Multiple Controls'
             color_value = 0.5
         else:
             action = 'ALLOW'
@@ -322,150 +487,185 @@ class GridEvaluator:
         }
 
 
+# Risk rows per user/platform/device: (user_risk, signin_risk, y-axis label suffix)
+RISK_VARIANTS = [
+    ('No Risk', 'No Risk', ''),
+    ('High', 'No Risk', '<br>⚠️ User Risk: High'),
+    ('No Risk', 'High', '<br>⚠️ Sign-in Risk: High'),
+]
+
+
+def scan_policies(policies: List[Dict[str, Any]]) -> Tuple[Dict[str, Set[str]], List[CompiledPolicy]]:
+    """Extract dimensions and compile policies in a single walk over the policy list"""
+    dimensions = PolicyParser._new_dimensions()
+    compiled = []
+    for policy in policies:
+        PolicyParser._add_policy_dimensions(dimensions, policy)
+        compiled.append(GridEvaluator._compile_policy(policy))
+    PolicyParser._add_default_dimensions(dimensions)
+    return dimensions, compiled
+
+
 class InteractiveVisualizer:
     """Create interactive Plotly visualization"""
     
     def __init__(self, policies: List[Dict[str, Any]]):
         self.policies = policies
-        self.parser = PolicyParser(policies)
-        self.evaluator = GridEvaluator(policies)
+        dimensions, compiled = scan_policies(policies)
+        self.parser = PolicyParser(policies, dimensions)
+        self.evaluator = GridEvaluator(policies, compiled)
+        # Labels of the rows / columns left out of the last create_matrix() because no policy applies to them
+        self.omitted_rows: List[str] = []
+        self.omitted_columns: List[str] = []
     
-    def create_matrix(self, max_per_dimension: int = 5) -> Tuple[List, List, List, List]:
-        """Create data matrix for heatmap"""
+    def create_matrix(self, max_per_dimension: int = 5, prune_unmatched: bool = False) -> Tuple[List, List, np.ndarray, List]:
+        """
+        Create data matrix for heatmap
+        With prune_unmatched, rows and columns where no policy applies to any cell (all
+        implicit Allow) are left out and their labels kept in omitted_rows / omitted_columns;
+        the full grid is kept if no policy applies anywhere
+        """
         dimensions = self.parser.get_top_dimensions(max_per_dimension)
         
-        # Build axes
-        x_axis_labels = []
-        y_axis_labels = []
-        
         # Y-axis: User × Platform × Device State × Risks
-        y_combinations = []
-        for user in dimensions['users']:
-            for platform in dimensions['platforms']:
-                for device_state in dimensions['device_states']:
-                    # To prevent matrix explosion, we'll only test "High Risk" scenarios 
-                    # if there are actually policies that use risk.
-                    # But for completeness, let's do a smart combination.
-                    
-                    # Base scenario (No Risk)
-                    label = f"{user}<br>[{platform}] ({device_state})"
-                    y_axis_labels.append(label)
-                    y_combinations.append({
-                        'user': user, 
-                        'platform': platform, 
-                        'device_state': device_state,
-                        'user_risk': 'No Risk',
-                        'signin_risk': 'No Risk'
-                    })
-                    
-                    # High User Risk scenario
-                    label_ur = f"{user}<br>[{platform}] ({device_state})<br>⚠️ User Risk: High"
-                    y_axis_labels.append(label_ur)
-                    y_combinations.append({
-                        'user': user, 
-                        'platform': platform, 
-                        'device_state': device_state,
-                        'user_risk': 'High',
-                        'signin_risk': 'No Risk'
-                    })
-                    
-                    # High Sign-in Risk scenario
-                    label_sr = f"{user}<br>[{platform}] ({device_state})<br>⚠️ Sign-in Risk: High"
-                    y_axis_labels.append(label_sr)
-                    y_combinations.append({
-                        'user': user, 
-                        'platform': platform, 
-                        'device_state': device_state,
-                        'user_risk': 'No Risk',
-                        'signin_risk': 'High'
-                    })
+        # Every user/platform/device row is tested with no risk, high user risk and
+        # high sign-in risk (one risk at a time, to keep the matrix from exploding)
+        y_product = list(itertools.product(
+            dimensions['users'], dimensions['platforms'], dimensions['device_states'], RISK_VARIANTS
+        ))
+        y_combinations = [
+            {
+                'user': user,
+                'platform': platform,
+                'device_state': device_state,
+                'user_risk': user_risk,
+                'signin_risk': signin_risk
+            }
+            for user, platform, device_state, (user_risk, signin_risk, _) in y_product
+        ]
         
         # X-axis: Application × Client Type × Location
-        x_combinations = []
-        for app in dimensions['applications']:
-            for client_type in dimensions['client_types']:
-                for location in dimensions['locations']:
-                    label = f"{app}<br>[{client_type}]<br>({location})"
-                    x_axis_labels.append(label)
-                    x_combinations.append({
-                        'application': app, 
-                        'client_type': client_type,
-                        'location': location
-                    })
-        
-        # Build matrix
-        data_matrix = []
+        x_product = list(itertools.product(
+            dimensions['applications'], dimensions['client_types'], dimensions['locations']
+        ))
+        x_combinations = [
+            {'application': app, 'client_type': client_type, 'location': location}
+            for app, client_type, location in x_product
+        ]
+        
+        y_axis_labels = [
+            f"{user}<br>[{platform}] ({device_state}){label_suffix}"
+            for user, platform, device_state, (_, _, label_suffix) in y_product
+        ]
+        x_axis_labels = [f"{app}<br>[{client_type}]<br>({location})" for app, client_type, location in x_product]
+        
+        # Evaluate every policy against the whole grid at once
+        matches = self.evaluator.match_grid(y_combinations, x_combinations)
+        
+        self.omitted_rows = []
+        self.omitted_columns = []
+        if prune_unmatched and matches.any():
+            live_rows = matches.any(axis=(0, 2))
+            live_columns = matches.any(axis=(0, 1))
+            self.omitted_rows = [y_axis_labels[i] for i in np.flatnonzero(~live_rows)]
+            self.omitted_columns = [x_axis_labels[j] for j in np.flatnonzero(~live_columns)]
+            
+            keep_rows = np.flatnonzero(live_rows)
+            keep_columns = np.flatnonzero(live_columns)
+            matches = matches[:, keep_rows][:, :, keep_columns]
+            y_axis_labels = [y_axis_labels[i] for i in keep_rows]
+            y_combinations = [y_combinations[i] for i in keep_rows]
+            x_axis_labels = [x_axis_labels[j] for j in keep_columns]
+            x_combinations = [x_combinations[j] for j in keep_columns]
+        
+        data_matrix = self.evaluator.color_values(matches)
+        
+        # Hover text = scenario lines (per cell) around the result's action header and
+        # details, which are summarized and formatted once per distinct set of matched policies
+        matched_sets, cell_classes = self.evaluator.match_classes(matches)
+        formatted_results = []
+        for matched in matched_sets:
+            result = self.evaluator.summarize(matched)
+            formatted_results.append((f"<b>{result['action']}</b><br>", self._format_result_details(result)))
+        cell_classes = cell_classes.tolist()
+        
+        # Build hover text matrix
         text_matrix = []
         
-        for y_combo in y_combinations:
-            row_values = []
+        for i, y_combo in enumerate(y_combinations):
             row_texts = []
             
-            for x_combo in x_combinations:
-                # Create full scenario
-                scenario = {**y_combo, **x_combo}
-                
-                # Evaluate
-                result = self.evaluator.evaluate_scenario(scenario)
-                
-                # Format hover text with policy names
-                hover_text = f"<b>{result['action']}</b><br>"
-                hover_text += f"User: {scenario['user']}<br>"
-                hover_text += f"App: {scenario['application']}<br>"
-                hover_text += f"Client: {scenario['client_type']}<br>"
-                hover_text += f"Platform: {scenario['platform']}<br>"
-                hover_text += f"Location: {scenario['location']}<br>"
-                hover_text += f"Device: {scenario['device_state']}<br>"
-                
-                if scenario.get('user_risk') == 'High':
-                    hover_text += f"User Risk: High<br>"
-                if scenario.get('signin_risk') == 'High':
-                    hover_text += f"Sign-in Risk: High<br>"
-                
-                if result['controls']:
-                    hover_text += f"<br><b>Grant Controls:</b><br>"
-                    for ctrl in result['controls'][:5]:
-                        hover_text += f"• {ctrl}<br>"
-                
-                if result.get('session_controls'):
-                    hover_text += f"<br><b>Session Controls:</b><br>"
-                    for ctrl in result['session_controls'][:3]:
-                        hover_text += f"• {ctrl}<br>"
-                
-                if result['policies']:
-                    hover_text += f"<br><b>Matched Policies:</b><br>"
-                    for policy in result['policies'][:5]:  # Show up to 5 policy names
-                        hover_text += f"• {policy}<br>"
-                    if len(result['policies']) > 5:
-                        hover_text += f"• ... and {len(result['policies']) - 5} more"
-                else:
-                    hover_text += "<br><i>No policies matched (Implicit Allow)</i>"
+            # Risk lines depend only on the row
+            risk_text = ''
+            if y_combo.get('user_risk') == 'High':
+                risk_text += "User Risk: High<br>"
+            if y_combo.get('signin_risk') == 'High':
+                risk_text += "Sign-in Risk: High<br>"
+            
+            for j, x_combo in enumerate(x_combinations):
+                header, details = formatted_results[cell_classes[i][j]]
                 
-                row_values.append(result['color_value'])
-                row_texts.append(hover_text)
+                row_texts.append(
+                    f"{header}"
+                    f"User: {y_combo['user']}<br>"
+                    f"App: {x_combo['application']}<br>"
+                    f"Client: {x_combo['client_type']}<br>"
+                    f"Platform: {y_combo['platform']}<br>"
+                    f"Location: {x_combo['location']}<br>"
+                    f"Device: {y_combo['device_state']}<br>"
+                    f"{risk_text}"
+                    f"{details}"
+                )
             
-            data_matrix.append(row_values)
             text_matrix.append(row_texts)
         
         return x_axis_labels, y_axis_labels, data_matrix, text_matrix
     
-    def plot(self, output_path: str = 'policy-matrix-interactive.html'):
-        """Generate interactive visualization"""
+    @staticmethod
+    def _format_result_details(result: Dict[str, Any]) -> str:
+        """Hover text section listing a result's controls and matched policy names"""
+        if not result['policies']:
+            return "<br><i>No policies matched (Implicit Allow)</i>"
+        
+        parts = []
+        if result['controls']:
+            parts.append("<br><b>Grant Controls:</b><br>")
+            parts.extend(f"• {ctrl}<br>" for ctrl in result['controls'][:5])
+        
+        if result.get('session_controls'):
+            parts.append("<br><b>Session Controls:</b><br>")
+            parts.extend(f"• {ctrl}<br>" for ctrl in result['session_controls'][:3])
+        
+        parts.append("<br><b>Matched Policies:</b><br>")
+        parts.extend(f"• {policy}<br>" for policy in result['policies'][:5])  # Show up to 5 policy names
+        if len(result['policies']) > 5:
+            parts.append(f"• ... and {len(result['policies']) - 5} more")
+        
+        return ''.join(parts)
+    
+    def plot(self, output_path: str = 'policy-matrix-interactive.html', prune_unmatched: bool = False):
+        """Generate interactive visualization (prune_unmatched: see create_matrix)"""
         print("Building interactive matrix...")
-        x_labels, y_labels, z_data, hover_text = self.create_matrix()
+        x_labels, y_labels, z_data, hover_text = self.create_matrix(prune_unmatched=prune_unmatched)
         
         print(f"  Matrix size: {len(y_labels)} × {len(x_labels)} = {len(y_labels) * len(x_labels)} cells")
+        if self.omitted_rows or self.omitted_columns:
+            # Every cell of these is implicit Allow; list them so the coverage gaps stay visible
+            print(f"    Omitted {len(self.omitted_rows)} rows and {len(self.omitted_columns)} columns "
+                  f"where no policy applies (implicit Allow):")
+            for label in self.omitted_rows:
+                print(f"      Row: {label.replace('<br>', ' ')}")
+            for label in self.omitted_columns:
+                print(f"      Column: {label.replace('<br>', ' ')}")
         
         # Count color distribution
-        from collections import Counter
-        flat_z = [val for row in z_data for val in row]
-        color_counts = Counter(flat_z)
-        print(f"    Red (BLOCK): {color_counts.get(0.0, 0)} cells")
-        print(f"    Orange (Controls): {color_counts.get(0.5, 0)} cells")
-        print(f"    Green (Allow): {color_counts.get(1.0, 0)} cells")
+        color_counts = np.bincount(z_data.ravel(), minlength=3)
+        print(f"    Red (BLOCK): {color_counts[CELL_BLOCK]} cells")
+        print(f"    Orange (Controls): {color_counts[CELL_CONTROLS]} cells")
+        print(f"    Green (Allow): {color_counts[CELL_ALLOW]} cells")
         
         # Create heatmap with discrete colors
-        # Use a discrete colorscale to ensure clear color separation
+        # Use a discrete colorscale to ensure clear color separation (codes 0/1/2 map to 0/0.5/1)
         colorscale = [
             [0.0, '#D32F2F'],    # Dark Red - Block
             [0.33, '#D32F2F'],   # Stay red until 0.33
@@ -483,8 +683,8 @@ class InteractiveVisualizer:
             hoverinfo='text',
             colorscale=colorscale,
             showscale=False,
-            zmin=0.0,  # Ensure scale starts at 0
-            zmax=1.0,  # Ensure scale ends at 1
+            zmin=CELL_BLOCK,  # Ensure scale starts at 0
+            zmax=CELL_ALLOW,  # Ensure scale ends at 2
             xgap=1,
             ygap=1
         ))
@@ -523,10 +723,17 @@ class InteractiveVisualizer:
         ]
         fig.update_layout(annotations=annotations)
         
-        # Save
-        fig.write_html(output_path)
+        # Save (plotly.js is loaded from the CDN rather than embedded, ~3.5 MB less per file)
+        html = fig.to_html(include_plotlyjs='cdn', include_mathjax=False, validate=False)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(html)
         print(f"  ✓ Saved interactive visualization to: {output_path}")
         
+        if WRITE_GZIP:
+            with gzip.open(f"{output_path}.gz", 'wt', encoding='utf-8') as f:
+                f.write(html)
+            print(f"  ✓ Saved compressed copy to: {output_path}.gz")
+        
         # Also try to open in browser
         try:
             import webbrowser
@@ -538,28 +745,52 @@ class InteractiveVisualizer:
         return output_path
 
 
+def _load_policy_file(yaml_file: Path) -> Tuple[Path, Any, Optional[Exception]]:
+    """Parse one policy file; errors are returned so they can be reported in file order"""
+    try:
+        with open(yaml_file, 'r', encoding='utf-8') as f:
+            return yaml_file, yaml.load(f, Loader=YAML_LOADER), None
+    except Exception as e:
+        return yaml_file, None, e
+
+
+def _policy_key(policy: Dict[str, Any]) -> bytes:
+    """Dedup key: digest of name, conditions and grant controls serialized with sorted keys"""
+    canonical = orjson.dumps(
+        {
+            'n': policy.get('DisplayName', ''),
+            'c': policy.get('Conditions', {}),
+            'g': policy.get('GrantControls', {})
+        },
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+        default=str  # any other YAML scalar types (e.g. !!binary, !!set)
+    )
+    return hashlib.blake2b(canonical, digest_size=16).digest()
+
+
 def load_policies(folder_path: Path) -> List[Dict[str, Any]]:
     """Load and deduplicate policies from YAML files"""
     policies = []
-    seen_policies = set()
+    seen_policies: Set[bytes] = set()
     
     yaml_files = list(folder_path.glob("*.yaml"))
     
-    for yaml_file in yaml_files:
+    # Read and parse files concurrently; deduplicate serially so results stay in file order
+    with ThreadPoolExecutor() as executor:
+        loaded = list(executor.map(_load_policy_file, yaml_files))
+    
+    for yaml_file, policy, error in loaded:
+        if error is not None:
+            print(f"Warning: Could not load {yaml_file.name}: {error}")
+            continue
         try:
-            with open(yaml_file, 'r', encoding='utf-8') as f:
-                policy = yaml.safe_load(f)
-                if policy and 'Conditions' in policy:
-                    # Deduplicate
-                    policy_key = (
-                        policy.get('DisplayName', ''),
-                        str(policy.get('Conditions', {})),
-                        str(policy.get('GrantControls', {}))
-                    )
-                    
-                    if policy_key not in seen_policies:
-                        policies.append(policy)
-                        seen_policies.add(policy_key)
+            if policy and 'Conditions' in policy:
+                # Deduplicate (key order in the YAML does not matter)
+                policy_key = _policy_key(policy)
+                
+                if policy_key not in seen_policies:
+                    policies.append(policy)
+                    seen_policies.add(policy_key)
         except Exception as e:
             print(f"Warning: Could not load {yaml_file.name}: {e}")
     
@@ -568,8 +799,6 @@ def load_policies(folder_path: Path) -> List[Dict[str, Any]]:
 
 def main():
     """Main entry point"""
-    import sys
-    
     print("=" * 70)
     print("Interactive Conditional Access Policy Visualizer")
     print("=" * 70)
@@ -633,7 +862,7 @@ def main():
     output_file = f"policy-matrix-{folder_name}.html"
     
     # Generate interactive plot
-    visualizer.plot(output_path=output_file)
+    visualizer.plot(output_path=output_file, prune_unmatched=PRUNE_UNMATCHED)
     
     print()
     print("=" * 70)
@@ -2,6 +2,8 @@ import json
 import itertools
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import plotly.graph_objects as go
 import pandas as pd
 
@@ -11,6 +13,16 @@ except ImportError:
     print("Error: PyYAML is not installed. Please run 'pip install pyyaml'")
     # We don't exit immediately to allow the script to run with sample data if needed,
     # but YAML loading will fail.
+else:
+    # libyaml's C parser when PyYAML was built with it (the PyPI wheels are), else pure Python
+    YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# orjson (C extension, in requirements.txt) parses JSON input faster; fall back to the stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # ==========================================
 # 1. INPUT DATA (Fallback Sample)
@@ -84,15 +96,45 @@ sample_json_input = """
 """
 
 class PolicyVisualizer:
+    # Define Colorscale
+    # 0 = Block (Red), 0.5 = Controls (Orange), 1 = Allow (Green)
+    _COLORSCALE = [
+        [0.0, '#EF5350'],   # Red
+        [0.5, '#FFCA28'],   # Amber
+        [1.0, '#66BB6A']    # Green
+    ]
+
+    _LAYOUT = dict(
+        title="Conditional Access Policy Coverage Map",
+        xaxis_title="Target Application & Device State",
+        yaxis_title="User Identity & Device Platform",
+        height=800,
+        width=1000,
+        xaxis=dict(tickangle=-45),
+        margin=dict(l=150, b=150)
+    )
+
+    _ANNOTATIONS = [
+        dict(x=1.05, y=1, xref='paper', yref='paper', text="<b>Legend</b>", showarrow=False),
+        dict(x=1.05, y=0.95, xref='paper', yref='paper', text="🟩 Allow (Implicit)", font=dict(color="green"), showarrow=False),
+        dict(x=1.05, y=0.92, xref='paper', yref='paper', text="🟨 Grant + Controls", font=dict(color="orange"), showarrow=False),
+        dict(x=1.05, y=0.89, xref='paper', yref='paper', text="🟥 Blocked", font=dict(color="red"), showarrow=False),
+    ]
+
     def __init__(self, policies_data):
         # Handle input: can be a JSON string (from sample) or a Python list (from YAML files)
         if isinstance(policies_data, str):
-            self.policies = json.loads(policies_data)
+            self.policies = _json_loads(policies_data)
         elif isinstance(policies_data, list):
             self.policies = policies_data
         else:
             raise ValueError("Invalid input format. Expected JSON string or List of policies.")
 
+        self._scan_policies()
+        self._fig = None # Built by the first plot()
+
+    def _scan_policies(self):
+        """(Re)reads axis dimensions and compiled conditions from the current self.policies."""
         self.dimensions = {
             "users": set(["Generic User"]),
             "apps": set(["Generic App"]),
@@ -101,76 +143,126 @@ class PolicyVisualizer:
             "trust": set(["Unmanaged", "Compliant"]) # Simplified device state
         }
         self._extract_dimensions()
+        # Conditions of each policy, read once per scan (parallel to self.policies)
+        self._compiled = [self._compile_conditions(p) for p in self.policies]
 
     def _extract_dimensions(self):
         """Scans policies to find specific IDs used in conditions."""
+        dimensions = self.dimensions
         for p in self.policies:
             conds = p.get('conditions', {})
             
             # Users/Groups
-            users = conds.get('users', {})
-            if 'includeGroups' in users:
-                self.dimensions['users'].update(users['includeGroups'])
+            groups = conds.get('users', {}).get('includeGroups')
+            if groups:
+                dimensions['users'].update(groups)
             
             # Apps
-            apps = conds.get('applications', {})
-            if 'includeApplications' in apps:
-                # Filter out "All" keyword from being a specific axis label
-                specifics = [a for a in apps['includeApplications'] if a != 'All']
-                self.dimensions['apps'].update(specifics)
+            # Filter out "All" keyword from being a specific axis label (set difference, no Python-level filter)
+            apps = conds.get('applications', {}).get('includeApplications')
+            if apps:
+                dimensions['apps'] |= set(apps) - {'All'}
             
             # Locations
-            locs = conds.get('locations', {})
-            if 'includeLocations' in locs:
-                specifics = [l for l in locs['includeLocations'] if l != 'All']
-                self.dimensions['locations'].update(specifics)
+            locs = conds.get('locations', {}).get('includeLocations')
+            if locs:
+                dimensions['locations'] |= set(locs) - {'All'}
 
-    def _check_match(self, policy, user, app, plat, loc, trust):
-        """Determines if a policy applies to a specific scenario."""
+    @staticmethod
+    def _compile_conditions(policy):
+        """Reads a policy's conditions once into frozensets (None = matches any value)."""
         conds = policy.get('conditions', {})
-        
-        # 1. Platform Check
         p_list = conds.get('platforms', {}).get('includePlatforms', [])
-        if 'all' not in p_list and plat not in p_list:
-            return False
-
-        # 2. User Check
-        u_inc = conds.get('users', {}).get('includeUsers', [])
-        g_inc = conds.get('users', {}).get('includeGroups', [])
-        g_exc = conds.get('users', {}).get('excludeGroups', [])
-        
-        # Simplified Inclusion Logic
-        user_match = False
-        if 'All' in u_inc: user_match = True
-        if user in g_inc: user_match = True
-        if user in g_exc: return False # Explicit Exclude wins
-        if not user_match: return False
-
-        # 3. App Check
+        users = conds.get('users', {})
         a_inc = conds.get('applications', {}).get('includeApplications', [])
-        if 'All' not in a_inc and app not in a_inc:
-            return False
-
-        # 4. Device Trust (Custom logic for this visualization)
-        # In real JSON this is a complex filter string. We use a simplified key here.
         req_trust = conds.get('device_trust', [])
-        if req_trust and trust not in req_trust:
-            return False
 
-        return True
+        return {
+            'plats': None if 'all' in p_list else frozenset(p_list),
+            'all_users': 'All' in users.get('includeUsers', []),
+            'g_inc': frozenset(users.get('includeGroups', [])),
+            'g_exc': frozenset(users.get('excludeGroups', [])),
+            'a_inc': None if 'All' in a_inc else frozenset(a_inc),
+            # Device Trust (Custom logic for this visualization)
+            # In real JSON this is a complex filter string. We use a simplified key here.
+            'trust': frozenset(req_trust) if req_trust else None,
+        }
+
+    @staticmethod
+    def _platform_ok(c, plat):
+        return c['plats'] is None or plat in c['plats']
+
+    @staticmethod
+    def _user_ok(c, user):
+        # Simplified Inclusion Logic: explicit exclude wins
+        return (c['all_users'] or user in c['g_inc']) and user not in c['g_exc']
+
+    @staticmethod
+    def _app_ok(c, app):
+        return c['a_inc'] is None or app in c['a_inc']
+
+    @staticmethod
+    def _trust_ok(c, trust):
+        return c['trust'] is None or trust in c['trust']
+
+    def _axis_masks(self, users, platforms, apps, trusts):
+        """Per-policy boolean vectors over each axis (a policy applies where all four are True)."""
+        n = len(self.policies)
+        u_mask = np.zeros((n, len(users)), dtype=bool)
+        p_mask = np.zeros((n, len(platforms)), dtype=bool)
+        a_mask = np.zeros((n, len(apps)), dtype=bool)
+        t_mask = np.zeros((n, len(trusts)), dtype=bool)
+
+        for i, c in enumerate(self._compiled):
+            p_mask[i] = [self._platform_ok(c, plat) for plat in platforms]
+            u_mask[i] = [self._user_ok(c, user) for user in users]
+            a_mask[i] = [self._app_ok(c, app) for app in apps]
+            t_mask[i] = [self._trust_ok(c, trust) for trust in trusts]
+
+        return u_mask, p_mask, a_mask, t_mask
+
+    def _match_classes(self, u_mask, p_mask, a_mask, t_mask):
+        """
+        Distinct sets of matching policy indices, and per cell (rows: user > platform,
+        columns: app > trust) the position of its set in that list.
+        """
+        n = len(self.policies)
+        rows = u_mask.shape[1] * p_mask.shape[1]
+        cols = a_mask.shape[1] * t_mask.shape[1]
+
+        # One bit per policy, in tiles of 64 policies: within a tile, a cell's matches are
+        # the AND of four uint64 axis words, so a cell needs one word per tile (not a bool per policy)
+        n_words = max(1, -(-n // 64))
+        cell_words = np.empty((n_words, rows * cols), dtype=np.uint64)
+        for w in range(n_words):
+            tile = slice(64 * w, 64 * (w + 1))
+            weights = np.left_shift(np.uint64(1), np.arange(len(self.policies[tile]), dtype=np.uint64))
+            u_bits, p_bits, a_bits, t_bits = (
+                (mask[tile] * weights[:, None]).sum(axis=0, dtype=np.uint64)
+                for mask in (u_mask, p_mask, a_mask, t_mask)
+            )
+            cell_words[w] = (
+                u_bits[:, None, None, None] & p_bits[None, :, None, None]
+                & a_bits[None, None, :, None] & t_bits[None, None, None, :]
+            ).ravel()
+
+        if n_words == 1:
+            keys, cell_codes = np.unique(cell_words[0], return_inverse=True)
+            keys = keys[:, None]
+        else:
+            keys, cell_codes = np.unique(cell_words.T, axis=0, return_inverse=True)
+
+        # Bit b of word w is policy 64*w + b
+        shifts = np.arange(64, dtype=np.uint64)
+        matched_sets = [np.flatnonzero((key[:, None] >> shifts) & np.uint64(1)) for key in keys]
+
+        return matched_sets, cell_codes.reshape(rows, cols)
 
     def evaluate_matrix(self):
         """Generates the heatmap data."""
-        
-        # Create Hierarchical Axes
-        y_axis_labels = [] # User > Platform
-        x_axis_labels = [] # App > Location > Trust
-        
-        # We perform a simplified Cartesian product
-        # To make the chart readable, we concatenate logical groups
-        
-        data_matrix = []
-        text_matrix = []
+        # Policies may have been edited since the last scan (see plot): re-read them so
+        # masks, labels, names and controls all come from the same policy list
+        self._scan_policies()
         
         # Sort for consistency
         users = sorted(list(self.dimensions['users']))
@@ -178,104 +270,94 @@ class PolicyVisualizer:
         apps = sorted(list(self.dimensions['apps']))
         trusts = sorted(list(self.dimensions['trust']))
         
-        # Build Y Axis (Who + What Device)
-        for user in users:
-            for plat in platforms:
-                y_label = f"{user} <br> [{plat}]"
-                y_axis_labels.append(y_label)
-                
-                row_values = []
-                row_texts = []
-                
-                # Build X Axis (Which App + Device State)
-                # Note: We loop X inside Y loop to build the row, 
-                # but we only build x_labels once.
-                for app in apps:
-                    for trust in trusts:
-                        x_label = f"{app} <br> ({trust})"
-                        if len(x_axis_labels) < (len(apps) * len(trusts)):
-                            x_axis_labels.append(x_label)
-                        
-                        # EVALUATION CORE
-                        applied_controls = []
-                        is_blocked = False
-                        matched_policies = []
-                        
-                        for pol in self.policies:
-                            if self._check_match(pol, user, app, plat, "Any", trust):
-                                matched_policies.append(pol['displayName'])
-                                grants = pol.get('grantControls', {}).get('builtInControls', [])
-                                sessions = pol.get('sessionControls', {})
-                                
-                                if 'block' in grants:
-                                    is_blocked = True
-                                else:
-                                    applied_controls.extend(grants)
-                                    if sessions:
-                                        applied_controls.append("Session Controls")
-
-                        # Determine Cell Color & Text
-                        if is_blocked:
-                            val = 0 # Red
-                            txt = f"BLOCKED<br>By: {matched_policies}"
-                        elif applied_controls:
-                            val = 0.5 # Orange
-                            unique_ctrls = list(set(applied_controls))
-                            txt = f"GRANTED ({', '.join(unique_ctrls)})<br>By: {matched_policies}"
-                        else:
-                            # Gray (No Policy = Default Allow in Azure AD usually, 
-                            # but purely visually we differentiate "Explicit" vs "Implicit")
-                            val = 1 # Green (Implicit Allow)
-                            txt = "Implicit Allow (No Policy Matched)"
-
-                        row_values.append(val)
-                        row_texts.append(txt)
-                
-                data_matrix.append(row_values)
-                text_matrix.append(row_texts)
+        # Create Hierarchical Axes
+        # Y Axis: User > Platform (Who + What Device), X Axis: App > Trust (Which App + Device State)
+        y_axis_labels = [f"{user} <br> [{plat}]" for user in users for plat in platforms]
+        x_axis_labels = [f"{app} <br> ({trust})" for app in apps for trust in trusts]
+        
+        # EVALUATION CORE
+        # Group cells by the set of policies that match them; color and text depend only on that set
+        axis_masks = self._axis_masks(users, platforms, apps, trusts)
+        matched_sets, cell_codes = self._match_classes(*axis_masks)
+
+        # Determine Cell Color & Text, once per distinct matched set
+        # (name and controls are only read from policies that matched something)
+        values = []
+        texts = []
+        for matched in matched_sets:
+            applied_controls = []
+            is_blocked = False
+            matched_policies = []
+
+            for i in matched:
+                pol = self.policies[i]
+                matched_policies.append(pol['displayName'])
+                grants = pol.get('grantControls', {}).get('builtInControls', [])
+                sessions = pol.get('sessionControls', {})
+
+                if 'block' in grants:
+                    is_blocked = True
+                else:
+                    applied_controls.extend(grants)
+                    if sessions:
+                        applied_controls.append("Session Controls")
+
+            if is_blocked:
+                val = 0 # Red
+                txt = f"BLOCKED<br>By: {matched_policies}"
+            elif applied_controls:
+                val = 0.5 # Orange
+                unique_ctrls = list(set(applied_controls))
+                txt = f"GRANTED ({', '.join(unique_ctrls)})<br>By: {matched_policies}"
+            else:
+                # Gray (No Policy = Default Allow in Azure AD usually, 
+                # but purely visually we differentiate "Explicit" vs "Implicit")
+                val = 1 # Green (Implicit Allow)
+                txt = "Implicit Allow (No Policy Matched)"
+
+            values.append(val)
+            texts.append(txt)
+
+        # Gather per-cell values with NumPy indexing (no per-cell Python loop); the
+        # arrays go to go.Heatmap as-is
+        data_matrix = np.array(values, dtype=np.float32)[cell_codes]
+        text_matrix = np.array(texts, dtype=object)[cell_codes]
 
         return x_axis_labels, y_axis_labels, data_matrix, text_matrix
 
     def plot(self):
         x, y, z, text = self.evaluate_matrix()
-        
-        # Define Colorscale
-        # 0 = Block (Red), 0.5 = Controls (Orange), 1 = Allow (Green)
-        colors = [
-            [0.0, '#EF5350'],   # Red
-            [0.5, '#FFCA28'],   # Amber
-            [1.0, '#66BB6A']    # Green
-        ]
-
-        fig = go.Figure(data=go.Heatmap(
-            z=z,
-            x=x,
-            y=y,
-            text=text,
-            hoverinfo='text', # Show our custom text on hover
-            colorscale=colors,
-            showscale=False,
-            xgap=1, # Grid lines
-            ygap=1
-        ))
-
-        fig.update_layout(
-            title="Conditional Access Policy Coverage Map",
-            xaxis_title="Target Application & Device State",
-            yaxis_title="User Identity & Device Platform",
-            height=800,
-            width=1000,
-            xaxis=dict(tickangle=-45),
-            margin=dict(l=150, b=150)
-        )
-        
-        # Add a custom legend (Annotations)
-        fig.add_annotation(x=1.05, y=1, xref='paper', yref='paper', text="<b>Legend</b>", showarrow=False)
-        fig.add_annotation(x=1.05, y=0.95, xref='paper', yref='paper', text="🟩 Allow (Implicit)", font=dict(color="green"), showarrow=False)
-        fig.add_annotation(x=1.05, y=0.92, xref='paper', yref='paper', text="🟨 Grant + Controls", font=dict(color="orange"), showarrow=False)
-        fig.add_annotation(x=1.05, y=0.89, xref='paper', yref='paper', text="🟥 Blocked", font=dict(color="red"), showarrow=False)
 
-        fig.show()
+        if self._fig is None:
+            # Build the figure skeleton once
+            self._fig = go.Figure(data=go.Heatmap(
+                z=z,
+                x=x,
+                y=y,
+                text=text,
+                hoverinfo='text', # Show our custom text on hover
+                colorscale=self._COLORSCALE,
+                showscale=False,
+                xgap=1, # Grid lines
+                ygap=1
+            ))
+            self._fig.update_layout(**self._LAYOUT)
+            # Add a custom legend (Annotations)
+            self._fig.update_layout(annotations=self._ANNOTATIONS)
+        else:
+            # Re-plot (e.g. after policy edits): only the matrix data changes
+            with self._fig.batch_update():
+                self._fig.update_traces(z=z, x=x, y=y, text=text)
+
+        self._fig.show()
+
+def load_yaml_file(file_path):
+    """Parses one YAML file; errors are returned so they can be reported in folder order."""
+    try:
+        with open(file_path, 'r') as f:
+            return yaml.load(f, Loader=YAML_LOADER), None
+    except Exception as e:
+        return None, e
 
 # ==========================================
 # MAIN EXECUTION
@@ -289,19 +371,21 @@ if __name__ == "__main__":
     
     if os.path.exists(target_folder):
         print(f"Scanning folder: {target_folder}...")
-        for filename in os.listdir(target_folder):
-            if filename.lower().endswith(('.yaml', '.yml')):
-                file_path = os.path.join(target_folder, filename)
-                try:
-                    with open(file_path, 'r') as f:
-                        content = yaml.safe_load(f)
-                        if isinstance(content, list):
-                            loaded_policies.extend(content)
-                        elif isinstance(content, dict):
-                            loaded_policies.append(content)
-                        print(f"Loaded: {filename}")
-                except Exception as e:
-                    print(f"Error loading {filename}: {e}")
+        yaml_files = [fn for fn in os.listdir(target_folder) if fn.lower().endswith(('.yaml', '.yml'))]
+
+        # Read and parse files concurrently, then collect them in folder order
+        with ThreadPoolExecutor() as executor:
+            results = executor.map(load_yaml_file, [os.path.join(target_folder, fn) for fn in yaml_files])
+
+            for filename, (content, error) in zip(yaml_files, results):
+                if error is not None:
+                    print(f"Error loading {filename}: {error}")
+                    continue
+                if isinstance(content, list):
+                    loaded_policies.extend(content)
+                elif isinstance(content, dict):
+                    loaded_policies.append(content)
+                print(f"Loaded: {filename}")
     else:
         print(f"Folder '{target_folder}' not found.")
 